@@ -21,14 +21,16 @@ logger.add(os.path.join(constants.LOGS_STORE, f"{datetime.now().strftime('%Y-%m-
 DATA = {
     # 'vehicle': pd.DataFrame(columns=["vehicle_id" ,"address", "capacity", "skills", "start_time", "end_time"]),
     # 'job': pd.DataFrame(columns=["job_id", "pickup_address", "delivery_address", "nb_passengers", "earliest_pickup", "service_time"]),
-    'vehicle': pd.read_csv("data/vehicles.csv"),
-    'job': pd.read_csv("data/jobs.csv"),
+    'vehicle': helpers.read_table("data/vehicles.csv", 'vehicle'),
+    'job': helpers.read_table("data/jobs.csv", 'job'),
     'vehicle_processed': None,
     'vehicle_scheduled': [],
     'job_processed': None,
     'solution': None,
     'preprocess_errors': None,
     'id_mapper': {'vehicle': dict(), 'job': dict()},
+    'matrix': None,
+    'preprocess_cache': routing.PreprocessCache(),
     'routes': dict()
 }
 DATA['job_selected'] = DATA['job'].copy()
@@ -78,8 +80,7 @@ def upload_file(files:gr.File, label:gr.Markdown) -> pd.DataFrame:
     if files is None:
         return DATA[obj_name]
     file_paths = [file.name for file in files]
-    dataframes = [pd.read_csv(file_path) for file_path in file_paths]
-    data = pd.concat(dataframes)
+    data = helpers.read_table(file_paths, obj_name)
     DATA[obj_name] = data
     DATA[f"{obj_name}_selected"] = data
     return data
@@ -105,6 +106,7 @@ def save_changes(df:pd.DataFrame, label:gr.Markdown) -> str:
     
     if len(df)==0:
         return "No changes to save"
+    df = helpers.coerce_table(df, obj_name)
     
     DATA[obj_name] = df
     DATA[f"{obj_name}_selected"] = df
@@ -122,9 +124,9 @@ def preprocess_data(session_id:str, vdf:pd.DataFrame, tasks:pd.DataFrame, task_t
         date = dates[0].strftime('%Y-%m-%d')
     session_id = str(session_id).split(":")[1].strip()
     if task_type=='shipment':
-        DATA['vehicle_processed'], _, DATA['job_processed'], DATA['preprocess_errors'], DATA['id_mapper'] = routing.preprocess(vdf, tasks=tasks, task_type=task_type, use_cache=use_cache, save=save, session_id=session_id)
+        DATA['vehicle_processed'], _, DATA['job_processed'], DATA['preprocess_errors'], DATA['id_mapper'], DATA['matrix'] = routing.preprocess(vdf, tasks=tasks, task_type=task_type, use_cache=use_cache, save=save, session_id=session_id, cache=DATA['preprocess_cache'])
     elif task_type=='job':
-        DATA['vehicle_processed'], DATA['job_processed'], _, DATA['preprocess_errors'], DATA['id_mapper'] = routing.preprocess(vdf, tasks=tasks, task_type=task_type, use_cache=use_cache, save=save, session_id=session_id)
+        DATA['vehicle_processed'], DATA['job_processed'], _, DATA['preprocess_errors'], DATA['id_mapper'], DATA['matrix'] = routing.preprocess(vdf, tasks=tasks, task_type=task_type, use_cache=use_cache, save=save, session_id=session_id, cache=DATA['preprocess_cache'])
     else:
         raise ValueError(f"Invalid task_type: {task_type}. Expected 'shipment' or 'job'")
     nb_vehicles = len(DATA['vehicle_processed'])
@@ -225,12 +227,13 @@ def optimize(session_id:str, task_type:str='shipment', vehicles:List[dict]=DATA.
         vehicles = DATA.get('vehicle_processed')
     if jobs is None:
         jobs = DATA.get('job_processed')
+    matrix = DATA.get('matrix') if constants.VROOM_USE_CUSTOM_MATRICES else None
 
     if task_type=='shipment':
-        solution = routing.optimize(vehicles, shipments=jobs, save=save, session_id=session_id)
+        solution = routing.optimize(vehicles, shipments=jobs, save=save, session_id=session_id, matrix=matrix)
         recipe = 'cpdptw'
     elif task_type=='job':
-        solution = routing.optimize(vehicles, jobs=jobs, save=save, session_id=session_id)
+        solution = routing.optimize(vehicles, jobs=jobs, save=save, session_id=session_id, matrix=matrix)
         recipe = 'cvrp'
     else:
         raise ValueError(f"Invalid task_type: {task_type}. Expected 'shipment' or 'job'")
@@ -255,7 +258,7 @@ def optimize(session_id:str, task_type:str='shipment', vehicles:List[dict]=DATA.
     unassigned_ids = list(map(lambda x: DATA['id_mapper'][task_type].get(x['id']), solution['unassigned']))
     unassigned = DATA['job_selected'].loc[DATA['job_selected']['job_id'].isin(unassigned_ids)]
 
-    lfmap = helpers.generate_leafmap(list(routes.values()), id_mapper=DATA['id_mapper'][task_type], jobs=DATA['job_selected'], vehicles=DATA['vehicle_selected'], unassigned=unassigned, recipe=recipe, zoom=10, height="500px", width="500px")
+    lfmap = helpers.generate_leafmap(list(routes.values()), id_mapper=DATA['id_mapper'][task_type], jobs=DATA['job_selected'], vehicles=DATA['vehicle_selected'], unassigned=unassigned, recipe=recipe, zoom=10, height="500px", width="500px", addresses=getattr(DATA.get('matrix'), 'addresses', None))
 
     summary = solution['summary']
     if recipe=='cpdptw':
@@ -268,13 +271,48 @@ def optimize(session_id:str, task_type:str='shipment', vehicles:List[dict]=DATA.
     veh_dropdown = gr.Dropdown(DATA['vehicle_scheduled'], label="Select a vehicle", elem_id="vehicle-picker", interactive=True)
     return format_summary(summary), format_unassigned(unassigned), lfmap, veh_dropdown
 
+@logger.catch
+def batch_data(session_id:str, vdf:pd.DataFrame, task_type:str='shipment', use_cache:bool=True, save:bool=False)->Tuple[str, str]:
+    if len(vdf)==0 or len(DATA['job'])==0:
+        return "Batch failed: no vehicles or jobs. Please first upload vehicles and jobs.", ""
+    session_id = str(session_id).split(":")[1].strip()
+    # every date of the Jobs tab, not only the selected one
+    results, summary = routing.batch(vdf, DATA['job'], task_type=task_type, use_cache=use_cache, save=save, session_id=session_id)
+
+    rows = []
+    nb_tasks = 0
+    for date, result in results.items():
+        if result is None or result['solution'] is None:
+            rows.append({'date': date, 'vehicles': '', 'jobs': '', 'errors': '', 'routes': '', 'unassigned jobs': '', 'status': 'failed'})
+            continue
+        tasks = len(result['shipments']) + len(result['jobs'])
+        unassigned = result['solution']['summary']['unassigned']
+        nb_tasks += tasks
+        rows.append({
+            'date': date,
+            'vehicles': len(result['vehicles']),
+            'jobs': tasks,
+            'errors': sum(len(items) for items in result['errors'].values()),
+            'routes': result['solution']['summary']['routes'],
+            'unassigned jobs': int(unassigned/2) if task_type=='shipment' else unassigned,
+            'status': 'solved'
+        })
+    res = f"- Dates: {summary['solved_dates']} solved out of {summary['dates']}"
+    res += "\n" + tomark.Tomark.table(rows)
+    if summary['solved_dates']==0:
+        return res, "Optimization failed"
+    if task_type=='shipment':
+        summary['unassigned'] = int(summary['unassigned']/2)
+    summary['assigned'] = nb_tasks - summary['unassigned']
+    return res, format_summary(summary)
+
 
 with gr.Blocks() as demo:
     gr.Markdown("## Vehicle Routing: Prototype")
     session_id = gr.Markdown(f"session: {str(int(datetime.timestamp(datetime.now())))}")
     with gr.Tab("Vehicles"):
         with gr.Row():
-            veh_input = gr.Files(file_types=[".csv", ".json"])
+            veh_input = gr.Files(file_types=[".csv", ".json", ".jsonl"])
         with gr.Row():
             with gr.Column(scale=1):
                 veh_submit_btn = gr.Button("Submit")
@@ -299,7 +337,7 @@ with gr.Blocks() as demo:
             veh_status_text = gr.Markdown("")
     with gr.Tab("Jobs"):
         with gr.Row():
-            job_input = gr.Files(file_types=[".csv", ".json"])
+            job_input = gr.Files(file_types=[".csv", ".json", ".jsonl"])
         with gr.Row():
             with gr.Column(scale=1):
                 job_submit_btn = gr.Button("Submit")
@@ -328,6 +366,7 @@ with gr.Blocks() as demo:
                 with gr.Row():
                     preprocess_button = gr.Button("Preprocess")
                     optimize_button = gr.Button("Optimize")
+                    batch_button = gr.Button("Optimize all dates")
                 with gr.Row():
                     process_output = gr.Markdown("")
                 with gr.Row():
@@ -387,6 +426,11 @@ with gr.Blocks() as demo:
         inputs=[session_id],
         outputs=[summary_output, unassigned_output, map_output, vehicle_picker]
     )
+    batch_button.click(
+        fn=batch_data,
+        inputs=[session_id, veh_output],
+        outputs=[process_output, summary_output]
+    )
     vehicle_picker.change(
         fn=lambda x: DATA['routes'].get(x),
         inputs=[vehicle_picker],
@@ -396,10 +440,12 @@ with gr.Blocks() as demo:
     
 
 
-logger.info("Starting demo server...")
-demo.launch(
-    share=True,
-    server_name=os.getenv("SERVER_NAME", "127.0.0.1"),
-    server_port=int(os.getenv("SERVER_PORT", "7861")),
-)
-logger.info("Demo server stopped.")
+# batch workers are spawned and import this module as __mp_main__, they must not launch the server
+if __name__ == "__main__":
+    logger.info("Starting demo server...")
+    demo.launch(
+        share=True,
+        server_name=os.getenv("SERVER_NAME", "127.0.0.1"),
+        server_port=int(os.getenv("SERVER_PORT", "7861")),
+    )
+    logger.info("Demo server stopped.")
@@ -7,6 +7,24 @@ OPENROUTESERVICE_BASE_URL = os.getenv('OPENROUTESERVICE_API_URL')
 
 VROOM_BASE_URL = os.getenv('VROOM_SERVER_URL','http://solver.vroom-project.org')
 OSRM_BASE_URL = os.getenv('OSRM_SERVER_URL','https://router.project-osrm.org')
+NOMINATIM_BASE_URL = os.getenv('NOMINATIM_SERVER_URL', 'https://nominatim.openstreetmap.org')
+GEOCODER = os.getenv('GEOCODER', 'nominatim') # 'nominatim' (NOMINATIM_BASE_URL) or 'local' (offline index at GEOCODER_INDEX)
+OSRM_TABLE_TILE_SIZE = int(os.getenv('OSRM_TABLE_TILE_SIZE', 100)) # max sources/destinations per table request
+OSRM_MAX_WORKERS = int(os.getenv('OSRM_MAX_WORKERS', 4)) # concurrent table requests
+OSRM_SLICE_URLS = {int(hour): url for hour, url in (item.split('=', 1) for item in os.getenv('OSRM_SLICE_SERVER_URLS', '').split(',') if '=' in item)} # e.g. "8=http://osrm-8am:5000,17=http://osrm-5pm:5000", OSRM servers customized with each time slice's traffic speeds
+MATRIX_TIME_SLICE_HOURS = int(os.getenv('MATRIX_TIME_SLICE_HOURS', 1)) # width of time-of-day matrix slices between DAY_START_HOUR and DAY_END_HOUR
+TRAFFIC_PROFILE = {int(hour): float(factor) for hour, factor in (item.split('=', 1) for item in os.getenv('TRAFFIC_PROFILE', '').split(',') if '=' in item)} # e.g. "8=1.25,16=1.3", measured duration multiplier per hour for slices without an OSRM server, 1 otherwise. Empty by default: slices equal the base matrix
+MATRIX_PROVIDER = os.getenv('MATRIX_PROVIDER', 'osrm') # 'osrm' or 'haversine' (offline great-circle estimate)
+MATRIX_FALLBACK_TO_HAVERSINE = os.getenv('MATRIX_FALLBACK_TO_HAVERSINE', 'true').lower() == 'true' # estimate the matrix when OSRM fails
+HAVERSINE_DETOUR_FACTOR = 1.3 # road distance / great-circle distance, used until fitted on cached OSRM results
+HAVERSINE_SPEED = 13.4 # m/s (~30 mph), used until fitted on cached OSRM results
+HAVERSINE_MIN_FIT_PAIRS = 100 # minimum cached OSRM pairs to fit the speed model
+MATRIX_MODE = os.getenv('MATRIX_MODE', 'dense') # 'dense' (all pairs) or 'sparse' (k-nearest, time-window compatible pairs only)
+SPARSE_K_NEAREST = int(os.getenv('SPARSE_K_NEAREST', 50)) # nearest compatible locations computed per location in sparse mode
+SPARSE_MAX_GAP = 60*60*3 # seconds, pairs whose time windows are further apart are not computed in sparse mode
+VROOM_USE_CUSTOM_MATRICES = os.getenv('VROOM_USE_CUSTOM_MATRICES', 'true').lower() == 'true' # send precomputed matrices so VROOM doesn't query OSRM again
+VROOM_UNROUTABLE_COST = 10**7 # duration/distance sent to VROOM for unroutable pairs
+BATCH_MAX_WORKERS = int(os.getenv('BATCH_MAX_WORKERS', min(4, os.cpu_count() or 1))) # service dates preprocessed and solved in parallel by routing.batch
 
 ALLOW_POOLING = False
 DEFAULT_VEHICLE_SIZE = 4
@@ -15,9 +33,60 @@ DAY_END_HOUR = 17 # HOUR
 MAX_WAIT_TIME = 60*5 #seconds
 DEFAULT_SERVICE_TIME = 60*5 #seconds
 
+GEOCODE_MAX_WORKERS = int(os.getenv('GEOCODE_MAX_WORKERS', 4)) # concurrent geocoding requests
+GEOCODE_RATE_LIMITS = { # requests per second by geocoding provider, 0 for unlimited
+    'nominatim': float(os.getenv('NOMINATIM_RATE_LIMIT', 1 if 'nominatim.openstreetmap.org' in NOMINATIM_BASE_URL else 0)),
+}
+GEOCODE_FAILURE_TTL = { # seconds a failed lookup is remembered (and not retried) by failure reason
+    'not_found': int(os.getenv('GEOCODE_NOT_FOUND_TTL', 60*60*24*30)),
+    'error': int(os.getenv('GEOCODE_ERROR_TTL', 60*60)),
+}
+GEOCODE_MAX_RETRIES = 4 # retries on 429/5xx responses and connection errors
+GEOCODE_BACKOFF = 1 # seconds, doubled after every retry
+GEOCODE_MAX_BACKOFF = 60 # seconds
+
 ADDRESS_STORE = "data/addresses.json"
+ADDRESS_DB = "data/addresses.sqlite"
+ADDRESS_DB_TIMEOUT = 30 # seconds to wait on the address database lock held by another process
+ADDRESS_CACHE_BACKEND = os.getenv('ADDRESS_CACHE_BACKEND', 'sqlite') # 'sqlite' (O(1) durable inserts, imports ADDRESS_STORE on first use) or 'json'
+ADDRESS_STRIP_ZIP = os.getenv('ADDRESS_STRIP_ZIP', 'true').lower() == 'true' # drop ZIP codes (last token or right after the state) from normalized address keys
+ADDRESS_STATE_CODES = ["al", "ak", "az", "ar", "ca", "co", "ct", "de", "dc", "fl", "ga", "hi", "id", "il", "in", "ia", "ks", "ky", "la", "me", "md", "ma", "mi", "mn", "ms", "mo",
+                       "mt", "ne", "nv", "nh", "nj", "nm", "ny", "nc", "nd", "oh", "ok", "or", "pa", "ri", "sc", "sd", "tn", "tx", "ut", "vt", "va", "wa", "wv", "wi", "wy",
+                       "pr", "gu", "vi", "as", "mp"] # state codes, never expanded as abbreviations in the state position (e.g. "fl", "ct")
+ADDRESS_COUNTRY_SUFFIXES = ["usa", "us", "united states", "united states of america"] # trailing country names dropped from normalized address keys
+ADDRESS_FUZZY_MATCH = os.getenv('ADDRESS_FUZZY_MATCH', 'false').lower() == 'true' # serve address cache misses from the most similar cached address instead of the geocoder (opt-in, a wrong match sends a driver to the wrong address)
+ADDRESS_FUZZY_THRESHOLD = float(os.getenv('ADDRESS_FUZZY_THRESHOLD', 0.75)) # minimum trigram similarity of a fuzzy address cache match (same house number, directions and street types)
+ADDRESS_DIRECTIONS = ["north", "south", "east", "west", "northeast", "northwest", "southeast", "southwest"] # (normalized) tokens a fuzzy address match must have exactly
+ADDRESS_STREET_TYPES = ["road", "street", "avenue", "boulevard", "drive", "lane", "court", "circle", "highway", "parkway", "place", "square", "terrace",
+                        "trail", "expressway", "freeway", "crescent", "way", "pike"] # (normalized) tokens a fuzzy address match must have exactly
+ADDRESS_UNIT_DESIGNATORS = ["apartment", "suite", "unit", "floor", "building", "room"] # (normalized) words introducing a unit, ignored with the unit by fuzzy address matching
+ADDRESS_ABBREVIATIONS = { # expanded in normalized address keys
+    "rd": "road", "st": "street", "ave": "avenue", "av": "avenue", "blvd": "boulevard", "dr": "drive", "ln": "lane",
+    "ct": "court", "cir": "circle", "hwy": "highway", "pkwy": "parkway", "pl": "place", "sq": "square", "ter": "terrace",
+    "trl": "trail", "expy": "expressway", "fwy": "freeway", "cres": "crescent",
+    "n": "north", "s": "south", "e": "east", "w": "west", "ne": "northeast", "nw": "northwest", "se": "southeast", "sw": "southwest",
+    "apt": "apartment", "ste": "suite", "bldg": "building", "fl": "floor", "mt": "mount", "ft": "fort",
+}
+GEOCODER_INDEX = os.getenv('GEOCODER_INDEX', "data/geocoder.sqlite") # built with helpers.build_geocoder_index from an address CSV or OSM XML extract
+GEOCODER_MIN_SCORE = 0.6 # minimum token overlap of a fuzzy local geocoder match
+MATRIX_STORE = "data/matrix"
+COORDINATE_PRECISION = 5 # decimals (~1m), geocodes equal at this precision share a matrix row
+MATRIX_CACHE_MAX_LOCATIONS = int(os.getenv('MATRIX_CACHE_MAX_LOCATIONS', 5000)) # least recently used locations are evicted beyond this
+TABLE_SCHEMAS = { # column types of uploaded vehicle and job files. Columns marked required must be present, rows with invalid required values are dropped
+    'vehicle': {
+        'vehicle_id': ('string', True), 'address': ('category', True), 'capacity': ('int32', True), 'skills': ('category', False),
+        'working_hours': ('category', True), 'breaks': ('category', False), 'available': ('category', False),
+    },
+    'job': {
+        'job_id': ('string', True), 'pickup_address': ('category', True), 'delivery_address': ('category', True), 'nb_passengers': ('int16', False),
+        'earliest_pickup': ('datetime', True), 'latest_delivery': ('datetime', True), 'service_time': ('int32', False), 'skills': ('category', False),
+    },
+}
+TABLE_DEFAULTS = {'nb_passengers': 1, 'service_time': DEFAULT_SERVICE_TIME} # values of missing optional numbers
+INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', 100000)) # rows per chunk when reading uploaded files
 PREPROCESSED_STORE = "data/preprocessed"
 SOLUTION_STORE = "data/solution"
+ARTIFACT_FORMAT = os.getenv('ARTIFACT_FORMAT', 'parquet') # 'parquet' (one dataset per table, partitioned by date, see helpers.read_artifact), 'msgpack' (one file per session) or 'json' (one file per object, see helpers.write_session)
 LOGS_STORE = "data/logs"
 LOG_LEVEL = os.getenv('LOG_LEVEL','INFO')
 
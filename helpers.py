@@ -1,70 +1,623 @@
 import constants
 
 import os
+import re
+import glob
 import json
+import time
+import itertools
+from array import array
+import fcntl
+import sqlite3
 import logging
-import polyline
-import folium
-import webcolors
+import threading
+import xml.etree.ElementTree as ET
 import requests
-import leafmap.foliumap as leafmap
+import orjson
 import numpy as np
 import pandas as pd
-import colorcet as cc
-from typing import Tuple, List, Union, Optional, Dict, Any
+from typing import Tuple, List, Union, Optional, Dict, Any, TYPE_CHECKING
 from datetime import datetime
 from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
 
-if not os.path.exists(constants.ADDRESS_STORE):
-    os.makedirs(os.path.dirname(constants.ADDRESS_STORE), exist_ok=True)
-    with open(constants.ADDRESS_STORE, "w") as f:
-        json.dump({}, f)
+if TYPE_CHECKING:
+    # imported when a map is generated, see generate_leafmap
+    import leafmap.foliumap as leafmap
 
-class AddressCache:
+def normalize_address(address:str, strip_zip:bool=constants.ADDRESS_STRIP_ZIP)->str:
+    """
+    Normalize an address into a cache key: case folding, punctuation and whitespace collapsing,
+    abbreviation expansion (constants.ADDRESS_ABBREVIATIONS) except for the state, and dropping trailing country names and optionally the ZIP code.
+    The state is the last token or the token before the ZIP code, and the ZIP code is the last token or the token after a state (constants.ADDRESS_STATE_CODES),
+    so 5-digit house numbers are kept
+
+    Parameters
+    ----------
+    address : str
+        Address to normalize
+    strip_zip : bool, optional
+        Drop the ZIP code (5 or 5+4 digits), by default constants.ADDRESS_STRIP_ZIP
+
+    Returns
+    -------
+    str
+        Normalized address
+
+    Examples
+    --------
+    >>> normalize_address("Baptist Health, 10500 Shelbyville Rd, Louisville, KY 40223, USA")
+    'baptist health 10500 shelbyville road louisville ky'
+    >>> normalize_address("Baptist Health, 10500 Shelbyville Rd, Louisville, KY") != normalize_address("Baptist Health, 10501 Shelbyville Rd, Louisville, KY")
+    True
+    >>> normalize_address("100 Oak Ct, Tampa, FL 33602-1234")
+    '100 oak court tampa fl'
+    """
+    tokens = re.findall(r"\d{5}-\d{4}|\w+", str(address).casefold())
+    while len(tokens) > 0:
+        for suffix in country_suffixes:
+            if tokens[-len(suffix):] == suffix:
+                del tokens[-len(suffix):]
+                break
+        else:
+            break
+    zips = {i for i, token in enumerate(tokens) if i > 0 and zip_pattern.fullmatch(token) and (i == len(tokens) - 1 or tokens[i - 1] in state_codes)}
+    normalized = []
+    for i, token in enumerate(tokens):
+        if i in zips:
+            if not strip_zip:
+                normalized.append(token.replace("-", " "))
+            continue
+        state = token in state_codes and (i + 1 in zips or i == len(tokens) - 1)
+        normalized.append(token if state else constants.ADDRESS_ABBREVIATIONS.get(token, token))
+    return " ".join(normalized)
+
+country_suffixes = sorted([suffix.split() for suffix in constants.ADDRESS_COUNTRY_SUFFIXES], key=len, reverse=True)
+state_codes = set(constants.ADDRESS_STATE_CODES)
+zip_pattern = re.compile(r"\d{5}(?:-\d{4})?")
+normalization_rules = json.dumps([constants.ADDRESS_STRIP_ZIP, constants.ADDRESS_COUNTRY_SUFFIXES, constants.ADDRESS_ABBREVIATIONS, constants.ADDRESS_STATE_CODES], sort_keys=True)
+
+def index_addresses(entries:Dict[str, Tuple[float, float]])->Dict[str, Tuple[float, float]]:
+    """
+    Index geocoded addresses by normalized address. Failed geocodes are left out so that they never shadow a variant that geocodes
+
+    Parameters
+    ----------
+    entries : Dict[str, Tuple[float, float]]
+        Geocode by address
+
+    Returns
+    -------
+    Dict[str, Tuple[float, float]]
+        Geocode by normalized address
+    """
+    return {normalize_address(address): geocode for address, geocode in entries.items() if geocode is not None}
+
+unit_pattern = re.compile(rf"\b(?:{'|'.join(constants.ADDRESS_UNIT_DESIGNATORS)}) \w+\b")
+directions = set(constants.ADDRESS_DIRECTIONS)
+street_types = set(constants.ADDRESS_STREET_TYPES)
+
+class TrigramIndex:
+    """
+    In-memory trigram index over normalized addresses, for fuzzy matches of typos and unit variants.
+    Addresses are added incrementally, units (constants.ADDRESS_UNIT_DESIGNATORS) are ignored, and a match must have the same signature as the query:
+    house number (leading number), directions (constants.ADDRESS_DIRECTIONS) and street types (constants.ADDRESS_STREET_TYPES), so "100 E Main St" never matches "100 W Main St"
+
+    Attributes
+    ----------
+    keys : List[str]
+        Indexed addresses
+    postings : Dict[Tuple[Tuple[Optional[str], Tuple[str, ...], Tuple[str, ...]], str], array]
+        Ids of the addresses containing each trigram, by signature and trigram
+    """
+    def __init__(self, keys:List[str]=[]):
+        self.keys = []
+        self.sizes = array('i')
+        self.ids = {}
+        self.postings = {}
+        for key in keys:
+            self.add(key)
+
+    @staticmethod
+    def trigrams(key:str)->set:
+        key = f"  {unit_pattern.sub(' ', key).strip()} "
+        return {key[i:i+3] for i in range(len(key) - 2)}
+
+    @staticmethod
+    def signature(key:str)->Tuple[Optional[str], Tuple[str, ...], Tuple[str, ...]]:
+        tokens = unit_pattern.sub(' ', key).split()
+        number = tokens[0] if len(tokens) > 0 and tokens[0][:1].isdigit() else None
+        return number, tuple(token for token in tokens if token in directions), tuple(token for token in tokens if token in street_types)
+
+    def add(self, key:str)->None:
+        if key in self.ids:
+            return
+        self.ids[key] = len(self.keys)
+        trigrams = self.trigrams(key)
+        signature = self.signature(key)
+        for trigram in trigrams:
+            self.postings.setdefault((signature, trigram), array('i')).append(len(self.keys))
+        self.keys.append(key)
+        self.sizes.append(len(trigrams))
+
+    def search(self, key:str, threshold:float=constants.ADDRESS_FUZZY_THRESHOLD)->Optional[str]:
+        """
+        Indexed address most similar to key (Jaccard similarity of trigrams) if at least threshold, None otherwise
+        """
+        trigrams = self.trigrams(key)
+        signature = self.signature(key)
+        postings = [np.frombuffer(self.postings[signature, trigram], dtype=np.int32) for trigram in trigrams if (signature, trigram) in self.postings]
+        if len(postings) == 0 or threshold > 1:
+            return None
+        candidates, shared = np.unique(np.concatenate(postings), return_counts=True)
+        similarity = shared/(len(trigrams) + np.frombuffer(self.sizes, dtype=np.int32)[candidates] - shared)
+        best = np.argmax(similarity)
+        return self.keys[candidates[best]] if similarity[best] >= threshold else None
+
+class JSONAddressStore:
+    """
+    Address cache storage in a single JSON file, shared between processes: writes hold an exclusive file lock,
+    merge the entries on disk with the new ones and replace the file atomically, so no process drops another's entries
+    """
     def __init__(self, filename:str=constants.ADDRESS_STORE):
         self.filename = filename
-        self.address_cache = json.load(open(filename, "r"))
+        self.failures_filename = f"{os.path.splitext(filename)[0]}.failures.json"
+        self.mtime = None
+        self.entries = dict()
+        self.normalized = dict()
+
+    def load(self)->Dict[str, Tuple[float, float]]:
+        if not os.path.exists(self.filename):
+            return dict()
+        self.mtime = os.path.getmtime(self.filename)
+        self.entries = json.load(open(self.filename, "r"))
+        self.normalized = index_addresses(self.entries)
+        return dict(self.entries)
+
+    def get(self, address:str, key:str)->Tuple[bool, Tuple[float, float]]:
+        if os.path.exists(self.filename) and os.path.getmtime(self.filename) != self.mtime:
+            with self.locked(fcntl.LOCK_SH):
+                self.load()
+        if address in self.entries:
+            return True, self.entries[address]
+        return key in self.normalized, self.normalized.get(key)
+
+    def locked(self, operation:int):
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        lock = open(f"{self.filename}.lock", "a")
+        fcntl.flock(lock, operation)
+        return lock
+
+    def dump(self, filename:str, data:Dict[str, Any])->None:
+        with open(f"{filename}.{os.getpid()}.tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(f"{filename}.{os.getpid()}.tmp", filename)
+
+    def write(self, entries:Dict[str, Tuple[float, float]])->None:
+        with self.locked(fcntl.LOCK_EX):
+            cache = self.load()
+            cache.update(entries)
+            self.dump(self.filename, cache)
+            self.load()
+
+    def load_failures(self)->Dict[str, Tuple[str, str, float]]:
+        if not os.path.exists(self.failures_filename):
+            return dict()
+        return {key: tuple(failure) for key, failure in json.load(open(self.failures_filename, "r")).items()}
+
+    def write_failures(self, failures:Dict[str, Optional[Tuple[str, str, float]]])->None:
+        with self.locked(fcntl.LOCK_EX):
+            stored = self.load_failures()
+            for key, failure in failures.items():
+                if failure is None:
+                    stored.pop(key, None)
+                else:
+                    stored[key] = failure
+            self.dump(self.failures_filename, stored)
+
+    def clear(self)->None:
+        with self.locked(fcntl.LOCK_EX):
+            self.dump(self.filename, {})
+            self.dump(self.failures_filename, {})
+            self.load()
+
+class SQLiteAddressStore:
+    """
+    Address cache storage in SQLite: each write only inserts the new entries in a transaction, so writes are O(1) and a crash never corrupts the cache.
+    The database is in WAL mode so that several processes can share it, and entries written by other processes are read through on cache misses.
+    The JSON cache is imported on first use
+    """
+    def __init__(self, filename:str=constants.ADDRESS_DB, import_from:Optional[str]=constants.ADDRESS_STORE):
+        self.filename = filename
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(filename, timeout=constants.ADDRESS_DB_TIMEOUT, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS addresses (address TEXT PRIMARY KEY, lon REAL, lat REAL, normalized TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS failures (normalized TEXT PRIMARY KEY, address TEXT, reason TEXT, failed_at REAL)")
+            if "normalized" not in [column[1] for column in self.connection.execute("PRAGMA table_info(addresses)")]:
+                self.connection.execute("ALTER TABLE addresses ADD COLUMN normalized TEXT")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS addresses_normalized ON addresses (normalized)")
+        imported = self.connection.execute("SELECT value FROM meta WHERE key='imported_from'").fetchone()
+        if imported is None and import_from is not None and os.path.exists(import_from):
+            entries = JSONAddressStore(import_from).load()
+            with self.connection:
+                self.insert(entries)
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('imported_from', ?)", (import_from,))
+            print(f"Imported {len(entries)} addresses from {import_from} into {filename}")
+        rules = self.connection.execute("SELECT value FROM meta WHERE key='normalization'").fetchone()
+        if rules is None or rules[0] != normalization_rules:
+            # normalized keys are recomputed whenever the normalization rules change
+            with self.connection:
+                self.insert(self.load())
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('normalization', ?)", (normalization_rules,))
+
+    def insert(self, entries:Dict[str, Tuple[float, float]])->None:
+        rows = [(address, None, None, None) if geocode is None else (address, geocode[0], geocode[1], normalize_address(address)) for address, geocode in entries.items()]
+        self.connection.executemany("INSERT OR REPLACE INTO addresses VALUES (?, ?, ?, ?)", rows)
+
+    def load(self)->Dict[str, Tuple[float, float]]:
+        with self.lock:
+            rows = self.connection.execute("SELECT address, lon, lat FROM addresses").fetchall()
+        return {address: None if lon is None else [lon, lat] for address, lon, lat in rows}
+
+    def get(self, address:str, key:str)->Tuple[bool, Tuple[float, float]]:
+        with self.lock:
+            row = self.connection.execute("SELECT lon, lat FROM addresses WHERE address=?", (address,)).fetchone()
+            if row is None:
+                row = self.connection.execute("SELECT lon, lat FROM addresses WHERE normalized=? LIMIT 1", (key,)).fetchone()
+        if row is None:
+            return False, None
+        return True, None if row[0] is None else [row[0], row[1]]
+
+    def write(self, entries:Dict[str, Tuple[float, float]])->None:
+        with self.lock, self.connection:
+            self.insert(entries)
+
+    def load_failures(self)->Dict[str, Tuple[str, str, float]]:
+        with self.lock:
+            rows = self.connection.execute("SELECT normalized, address, reason, failed_at FROM failures").fetchall()
+        return {key: (address, reason, failed_at) for key, address, reason, failed_at in rows}
+
+    def write_failures(self, failures:Dict[str, Optional[Tuple[str, str, float]]])->None:
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM failures WHERE normalized=?", [(key,) for key, failure in failures.items() if failure is None])
+            self.connection.executemany("INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?)", [(key, *failure) for key, failure in failures.items() if failure is not None])
+
+    def clear(self)->None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM addresses")
+            self.connection.execute("DELETE FROM failures")
+
+class AddressCache:
+    def __init__(self, filename:str=constants.ADDRESS_STORE, backend:str=constants.ADDRESS_CACHE_BACKEND, db:Optional[str]=None, fuzzy:bool=constants.ADDRESS_FUZZY_MATCH):
+        assert backend in ['json', 'sqlite'], f"Invalid backend {backend}. Valid backends are 'json' and 'sqlite'"
+        self.filename = filename
+        if backend=='sqlite':
+            # each JSON cache gets its own database next to it unless one is given
+            if db is None:
+                db = constants.ADDRESS_DB if filename == constants.ADDRESS_STORE else f"{os.path.splitext(filename)[0]}.sqlite"
+            self.store = SQLiteAddressStore(db, import_from=filename)
+        else:
+            self.store = JSONAddressStore(filename)
+        self.address_cache = self.store.load()
+        self.normalized = index_addresses(self.address_cache)
+        # fuzzy matches are only served when opted in, otherwise misses go to the geocoder
+        self.fuzzy = TrigramIndex(self.normalized) if fuzzy else None
+        self.failures = self.store.load_failures()
+        self.pending = dict()
+        self.pending_failures = dict()
+        self.lock = threading.Lock()
     
     def get(self, address:str)->Tuple[float, float]:
-        return self.address_cache.get(address)
+        if address in self.address_cache:
+            return self.address_cache[address]
+        key = normalize_address(address)
+        if key in self.normalized:
+            return self.normalized[key]
+        # read through entries written by other processes since this cache was loaded
+        found, geocode = self.store.get(address, key)
+        if found:
+            with self.lock:
+                self.address_cache[address] = geocode
+                if geocode is not None:
+                    self.normalized[key] = geocode
+                    if self.fuzzy is not None:
+                        self.fuzzy.add(key)
+            return geocode
+        if self.fuzzy is None:
+            return None
+        with self.lock:
+            match = self.fuzzy.search(key)
+        if match is None:
+            return None
+        print(f"fuzzy address match: {address} -> {match}")
+        return self.normalized[match]
     
     def update(self, address:str, geocode:Tuple[float, float], mode:str='hard')->None:
         assert mode in ['soft', 'hard'], f"Invalid mode {mode}. Valid modes are 'soft' and 'hard'"
-        self.address_cache[address] = geocode
+        with self.lock:
+            self.address_cache[address] = geocode
+            if geocode is not None:
+                key = normalize_address(address)
+                self.normalized[key] = geocode
+                if self.fuzzy is not None:
+                    self.fuzzy.add(key)
+                if key in self.failures:
+                    del self.failures[key]
+                    self.pending_failures[key] = None
+            self.pending[address] = geocode
         if mode=='hard':
             self.save()
+
+    def failure(self, address:str)->Optional[str]:
+        """
+        Reason of the last failed lookup of the (normalized) address if it has not expired yet, None otherwise
+        """
+        failure = self.failures.get(normalize_address(address))
+        if failure is None or time.time() - failure[2] >= constants.GEOCODE_FAILURE_TTL[failure[1]]:
+            return None
+        return failure[1]
+
+    def fail(self, address:str, reason:str, mode:str='hard')->None:
+        assert reason in constants.GEOCODE_FAILURE_TTL, f"Invalid reason {reason}. Valid reasons are {list(constants.GEOCODE_FAILURE_TTL)}"
+        assert mode in ['soft', 'hard'], f"Invalid mode {mode}. Valid modes are 'soft' and 'hard'"
+        key = normalize_address(address)
+        with self.lock:
+            self.failures[key] = self.pending_failures[key] = (address, reason, time.time())
+        if mode=='hard':
+            self.save()
+
+    def forget_failures(self, reasons:Optional[List[str]]=None, mode:str='hard')->List[str]:
+        """
+        Drop recorded failures (of the given reasons, by default all of them), expired or not, and return their addresses
+        """
+        assert mode in ['soft', 'hard'], f"Invalid mode {mode}. Valid modes are 'soft' and 'hard'"
+        with self.lock:
+            keys = [key for key, failure in self.failures.items() if reasons is None or failure[1] in reasons]
+            addresses = [self.failures.pop(key)[0] for key in keys]
+            self.pending_failures.update(dict.fromkeys(keys))
+        if mode=='hard':
+            self.save()
+        return addresses
     
     def save(self)->None:
-        with open(constants.ADDRESS_STORE, "w") as f:
-            json.dump(self.address_cache, f)
+        with self.lock:
+            if len(self.pending) > 0:
+                self.store.write(self.pending)
+            if len(self.pending_failures) > 0:
+                self.store.write_failures(self.pending_failures)
+            self.pending = dict()
+            self.pending_failures = dict()
     
     def reset(self, mode:str='soft')->None:
         assert mode in ['soft', 'hard'], f"Invalid mode {mode}. Valid modes are 'soft' and 'hard'"
-        self.address_cache = dict()
-        if mode=='hard':
-            self.save()
+        with self.lock:
+            self.address_cache = dict()
+            self.normalized = dict()
+            self.fuzzy = TrigramIndex() if self.fuzzy is not None else None
+            self.failures = dict()
+            self.pending = dict()
+            self.pending_failures = dict()
+            if mode=='hard':
+                self.store.clear()
+
+class RateLimiter:
+    """
+    Token bucket rate limiter shared by threads
+
+    Attributes
+    ----------
+    rate : float
+        Requests per second. 0 for unlimited
+    burst : int
+        Maximum number of requests allowed at once after idling
+    """
+    def __init__(self, rate:float, burst:int=1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self)->None:
+        """
+        Block until a request is allowed
+        """
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated)*self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            time.sleep(wait)
+
+def read_address_csv(source:str, chunksize:int=100000):
+    """
+    Read (address, longitude, latitude) records from a CSV file with either an address column
+    or OpenAddresses columns (number, street, city, region, postcode)
+    """
+    for chunk in pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=chunksize):
+        chunk.columns = [column.lower() for column in chunk.columns]
+        lon = next(column for column in ['lon', 'longitude', 'x'] if column in chunk.columns)
+        lat = next(column for column in ['lat', 'latitude', 'y'] if column in chunk.columns)
+        if 'address' in chunk.columns:
+            addresses = chunk['address']
+        else:
+            column = lambda name: chunk[name] if name in chunk.columns else ''
+            addresses = (chunk['number'] + " " + chunk['street']).str.strip() + ", " + column('city') + ", " + (column('region') + " " + column('postcode')).str.strip()
+        yield from zip(addresses, chunk[lon].astype(float), chunk[lat].astype(float))
+
+def read_address_osm(source:str):
+    """
+    Read (address, longitude, latitude) records from the addr:* tags of the nodes and ways (at their centroid) of an OSM XML extract
+    """
+    nodes = {}
+    refs = []
+    for _, element in ET.iterparse(source):
+        if element.tag == 'node':
+            nodes[element.get('id')] = (float(element.get('lon')), float(element.get('lat')))
+        elif element.tag == 'nd':
+            refs.append(element.get('ref'))
+        if element.tag in ['node', 'way']:
+            tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+            if 'addr:housenumber' in tags and 'addr:street' in tags:
+                address = f"{tags['addr:housenumber']} {tags['addr:street']}, {tags.get('addr:city', '')}, {tags.get('addr:state', '')} {tags.get('addr:postcode', '')}"
+                if element.tag == 'node':
+                    yield address, *nodes[element.get('id')]
+                else:
+                    # bbox extracts keep ways crossing the boundary without their outside nodes
+                    resolved = [nodes[ref] for ref in refs if ref in nodes]
+                    if len(resolved) > 0:
+                        lon, lat = np.mean(resolved, axis=0)
+                        yield address, lon, lat
+            refs = [] if element.tag == 'way' else refs
+            element.clear()
 
-address_cache = AddressCache()
-def get_geocode(address:str, use_cache:bool=True)->dict:
+def build_geocoder_index(source:str, index:str=constants.GEOCODER_INDEX, batch_size:int=100000)->int:
+    """
+    Build the offline geocoder index: every address is stored with its normalized form and its tokens, in SQLite
+
+    Parameters
+    ----------
+    source : str
+        Address CSV (address or OpenAddresses columns, plus lon/lat) or OSM XML extract (.osm)
+    index : str, optional
+        Index file to (re)build, by default constants.GEOCODER_INDEX
+    batch_size : int, optional
+        Number of addresses inserted per batch, by default 100000
+
+    Returns
+    -------
+    int
+        Number of indexed addresses
+    """
+    records = read_address_osm(source) if source.endswith('.osm') else read_address_csv(source)
+    os.makedirs(os.path.dirname(index) or ".", exist_ok=True)
+    if os.path.exists(index):
+        os.remove(index)
+    connection = sqlite3.connect(index)
+    connection.execute("CREATE TABLE places (id INTEGER PRIMARY KEY, address TEXT, normalized TEXT, lon REAL, lat REAL)")
+    connection.execute("CREATE TABLE tokens (token TEXT, place INTEGER)")
+    count = 0
+    while True:
+        batch = [(count + i, address, normalize_address(address), lon, lat) for i, (address, lon, lat) in enumerate(itertools.islice(records, batch_size))]
+        if len(batch) == 0:
+            break
+        with connection:
+            connection.executemany("INSERT INTO places VALUES (?, ?, ?, ?, ?)", batch)
+            connection.executemany("INSERT INTO tokens VALUES (?, ?)", [(token, place[0]) for place in batch for token in set(place[2].split())])
+        count += len(batch)
+    with connection:
+        connection.execute("CREATE INDEX places_normalized ON places (normalized)")
+        connection.execute("CREATE INDEX tokens_token ON tokens (token)")
+        connection.execute("CREATE TABLE vocabulary AS SELECT token, COUNT(*) AS count FROM tokens GROUP BY token")
+        connection.execute("CREATE UNIQUE INDEX vocabulary_token ON vocabulary (token)")
+    connection.close()
+    print(f"Indexed {count} addresses from {source} into {index}")
+    return count
+
+class LocalGeocoder:
+    """
+    Offline geocoder over an index built by build_geocoder_index. Addresses are matched on their normalized form first, then on tokens:
+    candidates share one of the query's rarest tokens, must contain all of its numbers (house number, ZIP) and overlap it by at least constants.GEOCODER_MIN_SCORE
+    """
+    def __init__(self, index:str=constants.GEOCODER_INDEX, min_score:float=constants.GEOCODER_MIN_SCORE):
+        assert os.path.exists(index), f"Geocoder index {index} not found. Build it with helpers.build_geocoder_index"
+        self.index = index
+        self.min_score = min_score
+        self.local = threading.local()
+
+    @property
+    def connection(self)->sqlite3.Connection:
+        # one read-only connection per thread
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = sqlite3.connect(f"file:{self.index}?mode=ro", uri=True)
+        return self.local.connection
+
+    def lookup(self, address:str, candidates:int=3)->Optional[List[float]]:
+        key = normalize_address(address)
+        row = self.connection.execute("SELECT lon, lat FROM places WHERE normalized=? LIMIT 1", (key,)).fetchone()
+        if row is not None:
+            return [row[0], row[1]]
+        tokens = set(key.split())
+        if len(tokens) == 0:
+            return None
+        counts = dict(self.connection.execute(f"SELECT token, count FROM vocabulary WHERE token IN ({','.join('?'*len(tokens))})", list(tokens)).fetchall())
+        numbers = {token for token in tokens if token.isdigit()}
+        # candidates share the rarest known token, then the next rarest one (in case the rarest is a wrong one, e.g. a misspelled city)
+        for token in sorted(counts, key=counts.get)[:candidates]:
+            rows = self.connection.execute("SELECT normalized, lon, lat FROM places WHERE id IN (SELECT place FROM tokens WHERE token=?)", (token,)).fetchall()
+            best, best_score = None, 0
+            for normalized, lon, lat in rows:
+                place = set(normalized.split())
+                if not numbers <= place:
+                    continue
+                score = len(tokens & place)/len(tokens | place)
+                if score >= self.min_score and score > best_score:
+                    best, best_score = [lon, lat], score
+            if best is not None:
+                return best
+        return None
+
+local_geocoder = None
+def get_local_geocoder()->LocalGeocoder:
+    global local_geocoder
+    if local_geocoder is None:
+        local_geocoder = LocalGeocoder()
+    return local_geocoder
+
+address_cache = None
+address_cache_lock = threading.Lock()
+def get_address_cache()->AddressCache:
+    """
+    Address cache shared by the geocoding functions, loaded on first use
+    """
+    global address_cache
+    with address_cache_lock:
+        if address_cache is None:
+            address_cache = AddressCache()
+    return address_cache
+
+rate_limiters = {provider: RateLimiter(rate) for provider, rate in constants.GEOCODE_RATE_LIMITS.items()}
+def get_geocode(address:str, use_cache:bool=True, mode:str='hard')->dict:
     """
     Get geocode for address's longitude and latitude
-    Note: This function uses OpenStreetMap's Nominatim API. So care to optimize for the rate limit or use a different API preferably local
+    Note: This function uses OpenStreetMap's Nominatim API, rate limited by constants.GEOCODE_RATE_LIMITS, or the offline index when constants.GEOCODER is 'local'. Prefer get_geocodes for many addresses.
+    429/5xx responses are retried with exponential backoff, and failed lookups are remembered for constants.GEOCODE_FAILURE_TTL by reason
 
     Parameters
     ----------
     address : str
         Address to get geocode for
+    use_cache : bool, optional
+        Use cache to get geocode, by default True
+    mode : str, optional
+        Cache update mode, by default 'hard' (saved right away). 'soft' leaves saving to the caller
     
     Returns
     -------
     dict
         Geocode for address
     """
+    address_cache = get_address_cache()
     if use_cache:
         if address_cache.get(address):
             return address_cache.get(address)
+        if address_cache.failure(address):
+            return None
+    if constants.GEOCODER == 'local':
+        # the local index answers in microseconds and is itself the cache, so results are not copied into address_cache
+        return get_local_geocoder().lookup(address)
     print(f"looking up a new address: {address}")
-    url = "https://nominatim.openstreetmap.org/search"
+    url = f"{constants.NOMINATIM_BASE_URL}/search"
     params = {
         "format": "json",
         "q": address
@@ -72,24 +625,410 @@ def get_geocode(address:str, use_cache:bool=True)->dict:
     headers = {
         "User-Agent": "NEMTOptimalRoutePlanner/0.0"
     }
-    response = requests.get(url, params=params, headers=headers)
-    if response.status_code == 200:
+    for attempt in range(constants.GEOCODE_MAX_RETRIES + 1):
+        rate_limiters['nominatim'].acquire()
+        try:
+            response = requests.get(url, params=params, headers=headers)
+        except requests.RequestException as e:
+            response = None
+            print(f"Failed to look up {address}: {e}")
+        if response is not None and response.status_code != 429 and response.status_code < 500:
+            break
+        if attempt < constants.GEOCODE_MAX_RETRIES:
+            delay = min(constants.GEOCODE_BACKOFF*2**attempt, constants.GEOCODE_MAX_BACKOFF)
+            if response is not None and response.headers.get('Retry-After', '').isdigit():
+                delay = min(float(response.headers['Retry-After']), constants.GEOCODE_MAX_BACKOFF)
+            time.sleep(delay)
+    if response is not None and response.status_code == 200:
         if len(response.json()) > 0:
             geocode = [float(response.json()[0].get('lon')), float(response.json()[0].get('lat'))]
             if use_cache:
-                address_cache.update(address, geocode)
+                address_cache.update(address, geocode, mode)
             return geocode
+        if use_cache:
+            address_cache.fail(address, 'not_found', mode)
         return None
     else:
-        address_cache.update(address, None)
+        if use_cache:
+            address_cache.fail(address, 'error', mode)
         return None
+
+def get_geocodes(addresses:List[str], use_cache:bool=True, max_workers:int=constants.GEOCODE_MAX_WORKERS)->Dict[str, Union[List[float], None]]:
+    """
+    Get geocodes for many addresses at once. Each unique normalized address is looked up once: cache hits are resolved right away
+    and misses through a pool of workers sharing the provider's rate limit. The cache is saved once at the end
+
+    Parameters
+    ----------
+    addresses : List[str]
+        Addresses to get geocodes for
+    use_cache : bool, optional
+        Use cache to get geocode, by default True
+    max_workers : int, optional
+        Maximum number of concurrent requests, by default constants.GEOCODE_MAX_WORKERS
+
+    Returns
+    -------
+    Dict[str, Union[List[float], None]]
+        Geocode by address, None for addresses that failed
+    """
+    address_cache = get_address_cache()
+    geocodes = {}
+    misses = {}
+    for address in dict.fromkeys(addresses):
+        geocode = address_cache.get(address) if use_cache else None
+        if geocode:
+            geocodes[address] = geocode
+        elif use_cache and address_cache.failure(address):
+            geocodes[address] = None
+        else:
+            misses.setdefault(normalize_address(address), []).append(address)
+    if len(misses) == 0:
+        return geocodes
+    print(f"looking up {len(misses)} new addresses")
+    queries = [variants[0] for variants in misses.values()]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(queries)))) as executor:
+        for variants, geocode in zip(misses.values(), executor.map(lambda address: get_geocode(address, use_cache, mode='soft'), queries)):
+            for address in variants:
+                geocodes[address] = geocode
+                if use_cache and geocode is not None and address != variants[0]:
+                    address_cache.update(address, geocode, mode='soft')
+    address_cache.save()
+    return geocodes
     
+class AddressTable:
+    """
+    Addresses of a preprocessing run resolved once, in bulk, and handed to every later stage (matrix, shipments, vehicles, map rendering)
+
+    Attributes
+    ----------
+    geocodes : Dict[str, Union[List[float], None]]
+        Geocode by unique address, None for addresses that failed
+    use_cache : bool
+        Use cache to get geocodes
+    elapsed : float
+        Seconds spent resolving addresses
+    """
+    def __init__(self, addresses:List[str], use_cache:bool=True)->None:
+        self.geocodes = {}
+        self.use_cache = use_cache
+        self.elapsed = 0
+        self.resolve(addresses)
+
+    def get(self, address:str)->Union[List[float], None]:
+        return self.geocodes.get(address)
+
+    def resolve(self, addresses:List[str])->Dict[str, Union[List[float], None]]:
+        """
+        Resolve the addresses that are not in the table yet or that failed, and return the geocodes of the table.
+        Failed addresses go through the address cache again, so they are looked up once their failure expires or is retried
+        """
+        missing = [address for address in dict.fromkeys(addresses) if self.geocodes.get(address) is None]
+        if len(missing) > 0:
+            start = time.perf_counter()
+            self.geocodes.update(get_geocodes(missing, self.use_cache))
+            self.elapsed += time.perf_counter() - start
+        return self.geocodes
+
+def retry_failed_addresses(reasons:Optional[List[str]]=None, max_workers:int=constants.GEOCODE_MAX_WORKERS)->Dict[str, Union[List[float], None]]:
+    """
+    Look up again every address whose lookup failed, whether its failure has expired or not
+
+    Parameters
+    ----------
+    reasons : List[str], optional
+        Only retry failures of these reasons (keys of constants.GEOCODE_FAILURE_TTL), by default all of them
+    max_workers : int, optional
+        Maximum number of concurrent requests, by default constants.GEOCODE_MAX_WORKERS
+
+    Returns
+    -------
+    Dict[str, Union[List[float], None]]
+        Geocode by retried address, None for addresses that failed again
+    """
+    address_cache = get_address_cache()
+    addresses = address_cache.forget_failures(reasons, mode='soft')
+    return get_geocodes(addresses, use_cache=True, max_workers=max_workers)
+
 def initialize_directories(directories:List[str]=[constants.PREPROCESSED_STORE, constants.SOLUTION_STORE, constants.LOGS_STORE])->None:
     print("Initializing directories")
     for directory in directories:
         os.makedirs(directory, exist_ok=True)
         print(f"Created directory {directory}")
 
+def coerce_table(df:pd.DataFrame, kind:str, offset:int=0, source:Optional[str]=None)->pd.DataFrame:
+    """
+    Validate and coerce the columns of a vehicle or job table to constants.TABLE_SCHEMAS.
+    Rows with a missing or invalid required value are dropped and reported
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Vehicles or jobs (or a chunk of them)
+    kind : str
+        'vehicle' or 'job'
+    offset : int, optional
+        Row number of the first row in its file, for reporting, by default 0
+    source : str, optional
+        File the rows were read from, for reporting, by default None
+
+    Returns
+    -------
+    pd.DataFrame
+        Coerced table
+    """
+    assert kind in constants.TABLE_SCHEMAS, f"Invalid kind {kind}. Valid kinds are {list(constants.TABLE_SCHEMAS)}"
+    schema = constants.TABLE_SCHEMAS[kind]
+    missing = [column for column, (_, required) in schema.items() if required and column not in df.columns]
+    if len(missing) > 0:
+        raise ValueError(f"Missing {kind} columns: {missing}")
+    df = df.copy()
+    invalid = pd.Series(False, index=df.index)
+    for column, (dtype, required) in schema.items():
+        if column not in df.columns:
+            continue
+        if dtype == 'datetime':
+            values = pd.to_datetime(df[column], format='ISO8601', errors='coerce')
+        elif dtype.startswith('int'):
+            values = pd.to_numeric(df[column], errors='coerce').fillna(constants.TABLE_DEFAULTS.get(column, np.nan))
+        else:
+            values = df[column]
+        # values that failed to parse and missing required values invalidate the row
+        invalid |= values.isna() & (df[column].notna() | required)
+        df[column] = values
+    if invalid.any():
+        rows = (np.flatnonzero(invalid.to_numpy()) + offset).tolist()
+        print(f"Dropped {len(rows)} {kind} rows{'' if source is None else f' of {source}'} with missing or invalid values: rows {rows[:10]}{'...' if len(rows) > 10 else ''}")
+        df = df.loc[~invalid]
+    for column, (dtype, _) in schema.items():
+        if column in df.columns:
+            df[column] = df[column].astype('datetime64[ns]' if dtype == 'datetime' else dtype)
+    return df
+
+def read_chunks(path:str, schema:Dict[str, Tuple[str, bool]], chunksize:int=constants.INGEST_CHUNK_SIZE):
+    """
+    Read a CSV, JSON Lines or JSON array file in chunks
+    """
+    if path.endswith('.csv'):
+        # numbers and datetimes are inferred and then coerced, so that one bad value does not fail the whole file
+        dtypes = {column: dtype for column, (dtype, _) in schema.items() if dtype in ('category', 'string')}
+        yield from pd.read_csv(path, dtype=dtypes, chunksize=chunksize)
+        return
+    with open(path, "r") as f:
+        head = f.read(1024).lstrip()
+    if head.startswith('['):
+        yield pd.read_json(path, orient='records', dtype=False, convert_dates=False)
+    else:
+        yield from pd.read_json(path, lines=True, dtype=False, convert_dates=False, chunksize=chunksize)
+
+def read_table(paths:Union[str, List[str]], kind:str, chunksize:int=constants.INGEST_CHUNK_SIZE)->pd.DataFrame:
+    """
+    Read vehicle or job files (CSV, JSON Lines, or JSON arrays) in chunks, coercing each chunk to constants.TABLE_SCHEMAS
+    so that no object-dtype copy of the whole files is ever built
+
+    Parameters
+    ----------
+    paths : Union[str, List[str]]
+        .csv, .jsonl/.ndjson or .json file(s)
+    kind : str
+        'vehicle' or 'job'
+    chunksize : int, optional
+        Rows per chunk, by default constants.INGEST_CHUNK_SIZE
+
+    Returns
+    -------
+    pd.DataFrame
+        Coerced table
+    """
+    schema = constants.TABLE_SCHEMAS[kind]
+    chunks = []
+    for path in [paths] if isinstance(paths, str) else paths:
+        # rows are reported by their number in their own file
+        offset = 0
+        for chunk in read_chunks(path, schema, chunksize):
+            chunks.append(coerce_table(chunk, kind, offset, os.path.basename(path)))
+            offset += len(chunk)
+    if len(chunks) == 0:
+        return pd.DataFrame({column: pd.Series(dtype='datetime64[ns]' if dtype == 'datetime' else dtype) for column, (dtype, _) in schema.items()})
+    df = pd.concat(chunks, ignore_index=True)
+    # chunks have their own categories, which pd.concat turns into objects
+    for column, (dtype, _) in schema.items():
+        if dtype == 'category' and column in df.columns and len(chunks) > 1:
+            df[column] = pd.api.types.union_categoricals([chunk[column] for chunk in chunks])
+    return df
+
+def dump_json(obj:Any)->bytes:
+    """
+    Encode an object (numpy values and non-string keys allowed) to compact JSON with orjson
+
+    Parameters
+    ----------
+    obj : Any
+        Object to encode
+
+    Returns
+    -------
+    bytes
+        UTF-8 JSON
+    """
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+def write_session(objects:Dict[str, Any], session_id:str, store:str, encoded:Optional[Dict[str, bytes]]=None, format:str=constants.ARTIFACT_FORMAT)->None:
+    """
+    Save the objects of a session: 'msgpack' writes them in a single store/session_id.msgpack file,
+    'json' writes one store/session_id_name.json file per object and reuses the JSON already encoded for an object (e.g. vroom request and response bodies) as is
+
+    Parameters
+    ----------
+    objects : Dict[str, Any]
+        Objects by name
+    session_id : str
+        Session id
+    store : str
+        Directory to save the session in
+    encoded : Dict[str, bytes], optional
+        JSON encoded objects by name, by default None
+    format : str, optional
+        'msgpack' or 'json', by default constants.ARTIFACT_FORMAT
+    """
+    assert format in ('msgpack', 'json'), f"Invalid format {format}. Valid formats are ['msgpack', 'json']"
+    if format == 'msgpack':
+        import msgpack
+        with open(os.path.join(store, f"{session_id}.msgpack"), "wb") as f:
+            f.write(msgpack.packb(objects))
+        return
+    encoded = encoded or {}
+    for name, obj in objects.items():
+        with open(os.path.join(store, f"{session_id}_{name}.json"), "wb") as f:
+            f.write(encoded[name] if name in encoded else dump_json(obj))
+
+def read_session(session_id:str, store:str)->Dict[str, Any]:
+    """
+    Read the objects of a session saved with write_session, in either format
+
+    Parameters
+    ----------
+    session_id : str
+        Session id
+    store : str
+        Directory the session was saved in
+
+    Returns
+    -------
+    Dict[str, Any]
+        Objects by name
+    """
+    filename = os.path.join(store, f"{session_id}.msgpack")
+    if os.path.exists(filename):
+        import msgpack
+        with open(filename, "rb") as f:
+            return msgpack.unpackb(f.read(), strict_map_key=False)
+    prefix = os.path.join(store, f"{session_id}_")
+    objects = {}
+    for filename in sorted(glob.glob(f"{prefix}*.json")):
+        with open(filename, "rb") as f:
+            objects[filename[len(prefix):-len(".json")]] = orjson.loads(f.read())
+    return objects
+
+def write_artifact(data:Union[pd.DataFrame, List[Dict[str, Any]]], name:str, session_id:str, date:str, store:str=constants.SOLUTION_STORE)->Optional[str]:
+    """
+    Write a table (dataframe or records, nested values allowed) as a Parquet file of the artifact dataset store/name.
+    Files are partitioned by date (store/name/date=YYYY-MM-DD/session_id.parquet) and carry date and session_id columns
+
+    Parameters
+    ----------
+    data : Union[pd.DataFrame, List[Dict[str, Any]]]
+        Table to write
+    name : str
+        Artifact name, e.g. 'shipments' or 'steps'
+    session_id : str
+        Session id
+    date : str
+        Date of the session
+    store : str, optional
+        Artifact store, by default constants.SOLUTION_STORE
+
+    Returns
+    -------
+    Optional[str]
+        Path of the written file, None for an empty table
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if len(data) == 0:
+        return None
+    if isinstance(data, pd.DataFrame):
+        table = pa.Table.from_pandas(data.assign(session_id=session_id, date=str(date)), preserve_index=False)
+    else:
+        # optional keys (e.g. step ids, vehicle breaks) may be missing from the first records, which would otherwise define the schema
+        keys = list(dict.fromkeys(key for record in data for key in record))
+        table = pa.Table.from_pydict({key: [record.get(key) for record in data] for key in keys}).append_column('session_id', pa.array([session_id] * len(data))).append_column('date', pa.array([str(date)] * len(data)))
+    directory = os.path.join(store, name, f"date={date}")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{session_id}.parquet")
+    pq.write_table(table, path)
+    return path
+
+def read_artifact(name:str, store:str=constants.SOLUTION_STORE, columns:Optional[List[str]]=None, date:Optional[str]=None, session_id:Optional[str]=None)->pd.DataFrame:
+    """
+    Read an artifact dataset written by write_artifact. Only the files of the requested date and only the requested columns are read
+
+    Parameters
+    ----------
+    name : str
+        Artifact name
+    store : str, optional
+        Artifact store, by default constants.SOLUTION_STORE
+    columns : List[str], optional
+        Columns to read, by default all of them
+    date : str, optional
+        Only read this date, by default all dates
+    session_id : str, optional
+        Only read this session, by default all sessions
+
+    Returns
+    -------
+    pd.DataFrame
+        Artifact table
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    pattern = os.path.join(store, name, "date=*" if date is None else f"date={date}", "*.parquet" if session_id is None else f"{session_id}.parquet")
+    files = sorted(glob.glob(pattern))
+    if len(files) == 0:
+        return pd.DataFrame(columns=columns)
+    # sessions may have different optional columns (e.g. vehicle breaks)
+    schema = pa.unify_schemas([pq.read_schema(file) for file in files])
+    return ds.dataset(files, schema=schema, format='parquet').to_table(columns=columns).to_pandas()
+
+def read_artifact_records(name:str, store:str=constants.SOLUTION_STORE, date:Optional[str]=None, session_id:Optional[str]=None)->List[Dict[str, Any]]:
+    """
+    Read an artifact dataset back as records (e.g. vroom vehicles or shipments), without the date and session_id columns and missing values
+
+    Parameters
+    ----------
+    name : str
+        Artifact name
+    store : str, optional
+        Artifact store, by default constants.SOLUTION_STORE
+    date : str, optional
+        Only read this date, by default all dates
+    session_id : str, optional
+        Only read this session, by default all sessions
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        Records as written
+    """
+    import pyarrow.parquet as pq
+    pattern = os.path.join(store, name, "date=*" if date is None else f"date={date}", "*.parquet" if session_id is None else f"{session_id}.parquet")
+    records = []
+    for file in sorted(glob.glob(pattern)):
+        records.extend({key: value for key, value in record.items() if value is not None and key not in ('date', 'session_id')} for record in pq.read_table(file).to_pylist())
+    return records
+
 def str_to_timestamp(dt:str)->int:
     """
     Convert datetime to timestamp
@@ -106,6 +1045,25 @@ def str_to_timestamp(dt:str)->int:
     """
     return int(datetime.strptime(dt, "%Y-%m-%d %H:%M:%S").timestamp())
 
+def datetimes_to_timestamps(dts:pd.Series)->List[Union[int, None]]:
+    """
+    Convert a column of (naive, local time) datetimes to timestamps, as str_to_timestamp does for each of them.
+    Each distinct datetime is converted once
+
+    Parameters
+    ----------
+    dts : pd.Series
+        Datetimes to convert
+
+    Returns
+    -------
+    List[Union[int, None]]
+        Timestamps, None for missing datetimes (NaT)
+    """
+    codes, uniques = pd.factorize(dts)
+    timestamps = [int(dt.to_pydatetime().replace(microsecond=0).timestamp()) for dt in uniques]
+    return [timestamps[code] if code >= 0 else None for code in codes]
+
 def str_to_seconds_past_midnight(dt:datetime)->int:
     """
     Convert datetime to seconds past midnight
@@ -181,6 +1139,27 @@ def get_timestamp_interval(date:datetime.date, interval:str)->List[int]:
     end_datetime = datetime.combine(date, end_time.time())
     return [start_datetime.timestamp(), end_datetime.timestamp()]
 
+def parse_intervals(intervals:pd.Series, date:datetime.date)->List[List[List[int]]]:
+    """
+    Parse a column of comma separated "HH:MM-HH:MM" intervals (e.g. working hours or breaks) into integer timestamp intervals on date.
+    Each distinct value is parsed once, and empty values give no interval
+
+    Parameters
+    ----------
+    intervals : pd.Series
+        Intervals to parse
+    date : datetime.date
+        Date of the intervals
+
+    Returns
+    -------
+    List[List[List[int]]]
+        Timestamp intervals of each row
+    """
+    codes, uniques = pd.factorize(intervals)
+    parsed = [[list(map(int, get_timestamp_interval(date, interval.strip()))) for interval in str(value).split(",") if interval.strip()] for value in uniques]
+    return [parsed[code] if code >= 0 else [] for code in codes]
+
 def parse_skills(skills:str)->List[int]:
     """
     Parse skills from string
@@ -239,6 +1218,67 @@ def compute_center_coordinates(coords:List[Tuple[float,float]])->Tuple[float, fl
     coords = np.array(coords)
     return coords.mean(axis=0).tolist()
 
+def round_coordinate(coord:Tuple[float,float], precision:int=constants.COORDINATE_PRECISION)->Tuple[float, float]:
+    """
+    Round coordinate so that geocodes of the same point compare equal
+
+    Parameters
+    ----------
+    coord : Tuple[float,float]
+        (longitude, latitude) coordinate
+    precision : int, optional
+        Number of decimals, by default constants.COORDINATE_PRECISION
+
+    Returns
+    -------
+    Tuple[float, float]
+        Rounded coordinate
+    """
+    return (round(float(coord[0]), precision), round(float(coord[1]), precision))
+
+def haversine(sources:np.ndarray, destinations:np.ndarray)->np.ndarray:
+    """
+    Compute great-circle distances between coordinates, element-wise (with numpy broadcasting)
+
+    Parameters
+    ----------
+    sources : np.ndarray
+        Array of (longitude, latitude) coordinates of shape (..., 2)
+    destinations : np.ndarray
+        Array of (longitude, latitude) coordinates of shape (..., 2)
+
+    Returns
+    -------
+    np.ndarray
+        float32 distances in meters
+    """
+    sources = np.radians(np.asarray(sources, dtype=np.float32))
+    destinations = np.radians(np.asarray(destinations, dtype=np.float32))
+    dlon = destinations[..., 0] - sources[..., 0]
+    dlat = destinations[..., 1] - sources[..., 1]
+    h = np.sin(dlat/2)**2 + np.cos(sources[..., 1])*np.cos(destinations[..., 1])*np.sin(dlon/2)**2
+    return np.float32(2*6371008.8)*np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+def haversine_matrix(sources:List[Tuple[float,float]], destinations:Optional[List[Tuple[float,float]]]=None)->np.ndarray:
+    """
+    Compute great-circle distance matrix between coordinates
+
+    Parameters
+    ----------
+    sources : List[Tuple[float,float]]
+        List of (longitude, latitude) coordinates
+    destinations : List[Tuple[float,float]], optional
+        List of (longitude, latitude) coordinates, by default sources
+
+    Returns
+    -------
+    np.ndarray
+        float32 distance matrix in meters of shape (len(sources), len(destinations))
+    """
+    sources = np.asarray(sources, dtype=np.float32).reshape(-1, 2)
+    destinations = sources if destinations is None else np.asarray(destinations, dtype=np.float32).reshape(-1, 2)
+    return haversine(sources[:, None, :], destinations[None, :, :])
+
 def build_osrm_path(coords:List[Tuple[float,float]], base_url:str=constants.OSRM_BASE_URL)->str:
     """
     Build OSRM path from list of coordinates
@@ -263,7 +1303,7 @@ def build_osrm_path(coords:List[Tuple[float,float]], base_url:str=constants.OSRM
     else:
         return ""
 
-def geojson_unassigned(unassigned_data:pd.DataFrame)->Dict[str, Any]:
+def geojson_unassigned(unassigned_data:pd.DataFrame, addresses:Optional[AddressTable]=None)->Dict[str, Any]:
     """
     Create GeoJSON from data
     
@@ -271,6 +1311,8 @@ def geojson_unassigned(unassigned_data:pd.DataFrame)->Dict[str, Any]:
     ----------
     unassigned_data : pd.DataFrame
         Data to create GeoJSON from
+    addresses : AddressTable, optional
+        Addresses resolved during preprocessing, by default None (geocoded again)
         
     Returns
     -------
@@ -278,12 +1320,14 @@ def geojson_unassigned(unassigned_data:pd.DataFrame)->Dict[str, Any]:
         GeoJSON
     """
     points = []
+    locations = unassigned_data["pickup_address"].tolist() + unassigned_data["delivery_address"].tolist()
+    geocodes = addresses.resolve(locations) if addresses is not None else get_geocodes(locations)
     for i, row in unassigned_data.iterrows():
         points.append({
             "type": "Feature",
             "geometry": {
                 "type": "Point",
-                "coordinates": get_geocode(row["pickup_address"], use_cache=True)
+                "coordinates": geocodes.get(row["pickup_address"])
             },
             "properties": {
                 "type": "pickup",
@@ -298,7 +1342,7 @@ def geojson_unassigned(unassigned_data:pd.DataFrame)->Dict[str, Any]:
             "type": "Feature",
             "geometry": {
                 "type": "Point",
-                "coordinates": get_geocode(row["delivery_address"], use_cache=True)
+                "coordinates": geocodes.get(row["delivery_address"])
             },
             "properties": {
                 "type": "delivery",
@@ -443,23 +1487,28 @@ def format_unassigned_popup(properties:Dict[str, Any])->str:
         raise Exception(f"Invalid type {properties['type']}. Valid types are 'pickup' and 'delivery'")
     return html
 
-def plot_vehicle_depots(m:leafmap.Map)->leafmap.Map:
+def plot_vehicle_depots(m:'leafmap.Map')->'leafmap.Map':
     pass
 
-def plot_vehicle_routes(m:leafmap.Map)->leafmap.Map:
+def plot_vehicle_routes(m:'leafmap.Map')->'leafmap.Map':
     pass
 
-def plot_unassigned_jobs(m:leafmap.Map)->leafmap.Map:
+def plot_unassigned_jobs(m:'leafmap.Map')->'leafmap.Map':
     pass
 
 
-def generate_leafmap(routes:List[Dict[str, Any]], id_mapper:Dict[str, Any], jobs:pd.DataFrame, vehicles:pd.DataFrame, unassigned:List[Dict[str, Any]]=[], recipe:str='cpdptw', zoom=8, height="500px", width="500px"):
+def generate_leafmap(routes:List[Dict[str, Any]], id_mapper:Dict[str, Any], jobs:pd.DataFrame, vehicles:pd.DataFrame, unassigned:List[Dict[str, Any]]=[], recipe:str='cpdptw', zoom=8, height="500px", width="500px", addresses:Optional[AddressTable]=None):
+    # the mapping stack is only imported when a map is generated
+    import folium
+    import polyline
+    import colorcet as cc
+    import leafmap.foliumap as leafmap
     assert recipe in ['cpdptw', 'cvrp'], f"Invalid recipe {recipe}. Valid recipes are 'cpdptw' and 'cvrp'"
     colors = cc.palette['glasbey_bw']
     m = leafmap.Map(zoom_start=zoom, height=height, width=width, tiles="OpenStreetMap")
     coordinates = []
     assigned_geojsons = list(map(lambda x: geojson_assigned(x, id_mapper, jobs, vehicles), routes))
-    unassigned_geojson = geojson_unassigned(unassigned)
+    unassigned_geojson = geojson_unassigned(unassigned, addresses)
     feature_groups = []
     layer_control = folium.LayerControl(collapsed=False)
 
@@ -521,6 +1570,7 @@ def generate_generic_leafmap(center:Tuple[float, float]=[44.58, -103.46], zoom:i
     Generate generic leafmap with center at given center coordinates and zoom level
 
     """
+    import leafmap.foliumap as leafmap
     m = leafmap.Map(center=center, zoom_start=zoom, height=height, width=width, tiles="OpenStreetMap")
     return m.to_gradio()
 
@@ -3,14 +3,20 @@ import helpers
 
 import json
 import os
+import fcntl
+import time
 import uuid
+import itertools
+import multiprocessing
 import traceback
 import requests
+import orjson
 import pandas as pd
 import numpy as np
-from typing import Tuple, List, Union, Optional, Dict, Any
+from typing import Tuple, List, Union, Optional, Dict, Any, Callable
 from pprint import pprint
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
 vroom_url = constants.VROOM_BASE_URL
@@ -19,6 +25,428 @@ vroom_url = constants.VROOM_BASE_URL
 logger = helpers.init_logger(__name__, level=constants.LOG_LEVEL)
 
 
+def fetch_table_tile(coords:List[Tuple[float, float]], sources:List[int], destinations:List[int], base_url:str=constants.OSRM_BASE_URL)->Tuple[np.ndarray, np.ndarray]:
+    """
+    Fetch a single sources x destinations tile from OSRM's table service
+
+    Parameters
+    ----------
+    coords : List[Tuple[float, float]]
+        List of (longitude, latitude) coordinates
+    sources : List[int]
+        Indices in coords of the tile's sources
+    destinations : List[int]
+        Indices in coords of the tile's destinations
+    base_url : str, optional
+        OSRM server URL, by default constants.OSRM_BASE_URL
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Duration (seconds) and distance (meters) tiles. Unroutable pairs are NaN
+    """
+    points = list(dict.fromkeys(list(sources) + list(destinations)))
+    position = {point: k for k, point in enumerate(points)}
+    coord_string = ";".join([f"{coords[point][0]},{coords[point][1]}" for point in points])
+    url = f"{base_url}/table/v1/driving/{coord_string}"
+    params = {
+        "sources": ";".join([str(position[source]) for source in sources]),
+        "destinations": ";".join([str(position[destination]) for destination in destinations]),
+        "annotations": "distance,duration"
+    }
+    response = requests.get(url, params=params)
+    if response.status_code != 200:
+        raise Exception(f"Failed to get {len(sources)}x{len(destinations)} table tile:\n{response.text}")
+    # null entries (unroutable pairs) become NaN
+    durations = np.array(response.json()['durations'], dtype=float)
+    distances = np.array(response.json()['distances'], dtype=float)
+    return durations, distances
+
+def fetch_table(coords:List[Tuple[float, float]], sources:Optional[List[int]]=None, destinations:Optional[List[int]]=None, tile_size:int=constants.OSRM_TABLE_TILE_SIZE, max_workers:int=constants.OSRM_MAX_WORKERS, base_url:str=constants.OSRM_BASE_URL)->Tuple[np.ndarray, np.ndarray]:
+    """
+    Fetch duration and distance matrices from OSRM's table service.
+    The matrix is split in tiles of at most tile_size sources and tile_size destinations which are fetched concurrently and stitched back together
+
+    Parameters
+    ----------
+    coords : List[Tuple[float, float]]
+        List of (longitude, latitude) coordinates
+    sources : List[int], optional
+        Indices in coords to use as sources, by default all
+    destinations : List[int], optional
+        Indices in coords to use as destinations, by default all
+    tile_size : int, optional
+        Maximum number of sources and destinations per request, by default constants.OSRM_TABLE_TILE_SIZE
+    max_workers : int, optional
+        Maximum number of concurrent requests, by default constants.OSRM_MAX_WORKERS
+    base_url : str, optional
+        OSRM server URL, by default constants.OSRM_BASE_URL
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Duration (seconds) and distance (meters) matrices of shape (len(sources), len(destinations))
+    """
+    sources = list(range(len(coords))) if sources is None else list(sources)
+    destinations = list(range(len(coords))) if destinations is None else list(destinations)
+    durations = np.full((len(sources), len(destinations)), np.nan)
+    distances = np.full((len(sources), len(destinations)), np.nan)
+    tiles = [(i, j) for i in range(0, len(sources), tile_size) for j in range(0, len(destinations), tile_size)]
+    if len(tiles) == 0:
+        return durations, distances
+
+    def fetch(tile:Tuple[int, int])->Tuple[np.ndarray, np.ndarray]:
+        i, j = tile
+        return fetch_table_tile(coords, sources[i:i+tile_size], destinations[j:j+tile_size], base_url)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tiles)))) as executor:
+        for (i, j), (duration_tile, distance_tile) in zip(tiles, executor.map(fetch, tiles)):
+            durations[i:i+duration_tile.shape[0], j:j+duration_tile.shape[1]] = duration_tile
+            distances[i:i+distance_tile.shape[0], j:j+distance_tile.shape[1]] = distance_tile
+    return durations, distances
+
+def estimate_matrices(coords:List[Tuple[float, float]], model:Dict[str, float])->Tuple[np.ndarray, np.ndarray]:
+    """
+    Estimate duration and distance matrices offline from great-circle distances
+
+    Parameters
+    ----------
+    coords : List[Tuple[float, float]]
+        List of (longitude, latitude) coordinates
+    model : Dict[str, float]
+        Speed model with 'detour' factor and 'speed' in m/s, see MatrixCache.speed_model
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        float32 duration (seconds) and distance (meters) matrices
+    """
+    distances = helpers.haversine_matrix(coords)
+    distances *= np.float32(model['detour'])
+    durations = distances/np.float32(model['speed'])
+    return durations, distances
+
+class MatrixCache:
+    """
+    Persistent store of OSRM durations/distances keyed by coordinate pairs.
+    Every coordinate seen is a node of a square matrix kept on disk, so only pairs involving new nodes have to be fetched from OSRM.
+    Pairs not fetched yet are NaN and unroutable pairs are inf.
+    Matrices are float32 .npy files memory-mapped read-only, so several processes share the same pages instead of each loading a private copy.
+    Saving merges the pairs stored by other processes in the meantime, under a file lock.
+
+    Attributes
+    ----------
+    directory : str
+        Directory where the store is persisted
+    max_locations : int
+        Maximum number of nodes kept. Least recently used nodes are evicted beyond it
+    nodes : List[str]
+        Coordinate keys of the nodes
+    index : Dict[str, int]
+        Lookup dictionary for nodes (coordinate key to index)
+    last_used : np.ndarray
+        Last time (timestamp) each node was looked up
+    durations : np.ndarray
+        Duration matrix between nodes in seconds
+    distances : np.ndarray
+        Distance matrix between nodes in meters
+    hits : int
+        Number of pairs served from the store
+    misses : int
+        Number of pairs that had to be fetched
+    """
+    def __init__(self, directory:str=constants.MATRIX_STORE, max_locations:int=constants.MATRIX_CACHE_MAX_LOCATIONS) -> None:
+        self.directory = directory
+        self.max_locations = max_locations
+        self.nodes = []
+        self.index = {}
+        self.last_used = np.zeros(0)
+        self.durations = np.full((0, 0), np.nan, dtype=np.float32)
+        self.distances = np.full((0, 0), np.nan, dtype=np.float32)
+        self.hits = 0
+        self.misses = 0
+        self.loaded = False
+        self.mtime = None
+        self.model = None
+
+    @staticmethod
+    def key(coord:Tuple[float, float])->str:
+        return ",".join([f"{value:.{constants.COORDINATE_PRECISION}f}" for value in helpers.round_coordinate(coord)])
+
+    def load(self, lock:bool=True)->None:
+        """
+        Load the store from disk. Called on first use.
+        The files are read under a shared lock so a concurrent save can't swap some of them in between
+
+        Parameters
+        ----------
+        lock : bool, optional
+            Take the shared lock, by default True. False when the caller already holds the exclusive lock (save)
+        """
+        self.loaded = True
+        nodes_file = os.path.join(self.directory, "nodes.json")
+        if not os.path.exists(nodes_file):
+            return
+        try:
+            with open(os.path.join(self.directory, ".lock"), "a") as lock_file:
+                if lock:
+                    fcntl.flock(lock_file, fcntl.LOCK_SH)
+                mtime = os.path.getmtime(nodes_file)
+                nodes = json.load(open(nodes_file, "r"))
+                durations = np.load(os.path.join(self.directory, "durations.npy"), mmap_mode='r')
+                distances = np.load(os.path.join(self.directory, "distances.npy"), mmap_mode='r')
+        except Exception:
+            logger.error(f"Failed to load matrix cache from {self.directory}, starting empty")
+            logger.error(traceback.format_exc())
+            return
+        self.nodes = nodes['nodes']
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        self.last_used = np.array(nodes['last_used'], dtype=float)
+        self.durations = durations
+        self.distances = distances
+        self.mtime = mtime
+
+    def lookup(self, coords:List[Tuple[float, float]])->Tuple[np.ndarray, np.ndarray]:
+        """
+        Get cached durations and distances between coordinates
+
+        Parameters
+        ----------
+        coords : List[Tuple[float, float]]
+            List of (longitude, latitude) coordinates
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Duration and distance matrices of shape (len(coords), len(coords)). Pairs not cached are NaN
+        """
+        if not self.loaded:
+            self.load()
+        durations = np.full((len(coords), len(coords)), np.nan, dtype=np.float32)
+        distances = np.full((len(coords), len(coords)), np.nan, dtype=np.float32)
+        positions = [i for i, coord in enumerate(coords) if self.key(coord) in self.index]
+        nodes = [self.index[self.key(coords[i])] for i in positions]
+        if len(nodes) > 0:
+            durations[np.ix_(positions, positions)] = self.durations[np.ix_(nodes, nodes)]
+            distances[np.ix_(positions, positions)] = self.distances[np.ix_(nodes, nodes)]
+            self.last_used[nodes] = time.time()
+        missing = int(np.isnan(durations).sum())
+        self.hits += durations.size - missing
+        self.misses += missing
+        return durations, distances
+
+    def update(self, coords:List[Tuple[float, float]], durations:np.ndarray, distances:np.ndarray)->None:
+        """
+        Store durations and distances between coordinates, adding new coordinates as nodes and evicting the least recently used ones beyond max_locations
+
+        Parameters
+        ----------
+        coords : List[Tuple[float, float]]
+            List of (longitude, latitude) coordinates
+        durations : np.ndarray
+            Duration matrix of shape (len(coords), len(coords))
+        distances : np.ndarray
+            Distance matrix of shape (len(coords), len(coords))
+        """
+        if not self.loaded:
+            self.load()
+        nodes = self.add_nodes([self.key(coord) for coord in coords])
+        self.durations[np.ix_(nodes, nodes)] = durations
+        self.distances[np.ix_(nodes, nodes)] = distances
+        self.last_used[nodes] = time.time()
+        self.model = None
+        if len(self.nodes) > self.max_locations:
+            self.evict()
+
+    def add_nodes(self, keys:List[str])->List[int]:
+        """
+        Add the coordinate keys not stored yet as nodes and make the matrices writable
+
+        Parameters
+        ----------
+        keys : List[str]
+            Coordinate keys
+
+        Returns
+        -------
+        List[int]
+            Node index of each key
+        """
+        new_nodes = list(dict.fromkeys([key for key in keys if key not in self.index]))
+        if len(new_nodes) > 0 or not self.durations.flags.writeable:
+            # memory-mapped matrices are read-only, updates go to a private copy until saved
+            size = len(self.nodes) + len(new_nodes)
+            self.durations = self.resize(self.durations, size)
+            self.distances = self.resize(self.distances, size)
+            self.last_used = np.concatenate([self.last_used, np.zeros(len(new_nodes))])
+            for node in new_nodes:
+                self.index[node] = len(self.nodes)
+                self.nodes.append(node)
+        return [self.index[key] for key in keys]
+
+    def merge(self, other:'MatrixCache')->None:
+        """
+        Add the pairs stored in another cache, which take precedence over the pairs stored in this one
+
+        Parameters
+        ----------
+        other : MatrixCache
+            Cache to merge
+        """
+        nodes = self.add_nodes(other.nodes)
+        for matrix, values in ((self.durations, other.durations), (self.distances, other.distances)):
+            matrix[np.ix_(nodes, nodes)] = np.where(np.isnan(values), matrix[np.ix_(nodes, nodes)], values)
+        self.last_used[nodes] = np.maximum(self.last_used[nodes], other.last_used)
+        self.model = None
+        if len(self.nodes) > self.max_locations:
+            self.evict()
+
+    @staticmethod
+    def resize(matrix:np.ndarray, size:int)->np.ndarray:
+        resized = np.full((size, size), np.nan, dtype=np.float32)
+        resized[:matrix.shape[0], :matrix.shape[1]] = matrix
+        return resized
+
+    def evict(self)->None:
+        """
+        Drop the least recently used nodes until max_locations nodes remain
+        """
+        keep = np.sort(np.argsort(-self.last_used, kind='stable')[:self.max_locations])
+        logger.info(f"Evicting {len(self.nodes)-len(keep)} locations from matrix cache")
+        self.nodes = [self.nodes[i] for i in keep]
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        self.last_used = self.last_used[keep]
+        self.durations = self.durations[np.ix_(keep, keep)]
+        self.distances = self.distances[np.ix_(keep, keep)]
+
+    def save(self)->None:
+        """
+        Persist the store to disk. Each file is written to a temporary file first and then renamed so readers never see partial writes.
+        If another process saved the store since it was loaded, its pairs are merged first so concurrent runs (e.g. routing.batch) don't drop each other's pairs
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            nodes_file = os.path.join(self.directory, "nodes.json")
+            if os.path.exists(nodes_file) and os.path.getmtime(nodes_file) != self.mtime:
+                stored = MatrixCache(self.directory, self.max_locations)
+                stored.load(lock=False)
+                stored.merge(self)
+                self.nodes, self.index, self.last_used, self.durations, self.distances = stored.nodes, stored.index, stored.last_used, stored.durations, stored.distances
+            for name, matrix in (("durations.npy", self.durations), ("distances.npy", self.distances)):
+                path = os.path.join(self.directory, name)
+                with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+                    np.save(f, matrix)
+                os.replace(f"{path}.{os.getpid()}.tmp", path)
+            with open(f"{nodes_file}.{os.getpid()}.tmp", "w") as f:
+                json.dump({"nodes": self.nodes, "last_used": self.last_used.tolist()}, f)
+            os.replace(f"{nodes_file}.{os.getpid()}.tmp", nodes_file)
+            self.mtime = os.path.getmtime(nodes_file)
+
+    def speed_model(self, sample_size:int=100000)->Dict[str, float]:
+        """
+        Fit the great-circle speed model on cached OSRM results: road distance = detour * great-circle distance and duration = road distance / speed.
+        Defaults from constants are used while fewer than constants.HAVERSINE_MIN_FIT_PAIRS pairs are cached
+
+        Parameters
+        ----------
+        sample_size : int, optional
+            Maximum number of cached pairs used for the fit, by default 100000
+
+        Returns
+        -------
+        Dict[str, float]
+            'detour' factor, 'speed' in m/s and number of 'pairs' used
+        """
+        if self.model is not None:
+            return self.model
+        if not self.loaded:
+            self.load()
+        model = {"detour": constants.HAVERSINE_DETOUR_FACTOR, "speed": constants.HAVERSINE_SPEED, "pairs": 0}
+        if len(self.nodes) > 1:
+            rng = np.random.default_rng(0)
+            sources = rng.integers(0, len(self.nodes), sample_size)
+            destinations = rng.integers(0, len(self.nodes), sample_size)
+            durations = np.asarray(self.durations[sources, destinations], dtype=float)
+            distances = np.asarray(self.distances[sources, destinations], dtype=float)
+            coords = np.array([node.split(",") for node in self.nodes], dtype=float)
+            great_circle = helpers.haversine(coords[sources], coords[destinations]).astype(float)
+            valid = np.isfinite(durations) & np.isfinite(distances) & (durations > 0) & (great_circle > 100)
+            if valid.sum() >= constants.HAVERSINE_MIN_FIT_PAIRS:
+                model = {
+                    "detour": float(np.median(distances[valid]/great_circle[valid])),
+                    "speed": float(distances[valid].sum()/durations[valid].sum()),
+                    "pairs": int(valid.sum())
+                }
+        self.model = model
+        return model
+
+    def stats(self)->Dict[str, Any]:
+        """
+        Get cache statistics
+
+        Returns
+        -------
+        Dict[str, Any]
+            Number of locations stored, pair hits and misses and hit rate
+        """
+        total = self.hits + self.misses
+        return {
+            "locations": len(self.nodes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits/total if total > 0 else 0.0
+        }
+
+def time_slices()->List[int]:
+    """
+    Get start hours of the time-of-day matrix slices between constants.DAY_START_HOUR and constants.DAY_END_HOUR
+
+    Returns
+    -------
+    List[int]
+        Start hour of each slice
+    """
+    return list(range(constants.DAY_START_HOUR, constants.DAY_END_HOUR, constants.MATRIX_TIME_SLICE_HOURS))
+
+def slice_of(times:Union[List[datetime], np.ndarray, pd.Series])->np.ndarray:
+    """
+    Get the time slice matching each time. Times outside the day are mapped to the first/last slice
+
+    Parameters
+    ----------
+    times : Union[List[datetime], np.ndarray, pd.Series]
+        Times
+
+    Returns
+    -------
+    np.ndarray
+        Start hour of the slice of each time
+    """
+    times = pd.DatetimeIndex(pd.to_datetime(np.asarray(times)))
+    hours = times.hour.to_numpy() + times.minute.to_numpy()/60
+    slices = np.array(time_slices())
+    return slices[np.clip(np.searchsorted(slices, hours, side='right') - 1, 0, len(slices) - 1)]
+
+slice_caches = {}
+def slice_cache(start:int)->MatrixCache:
+    """
+    Get the persistent matrix store of a time slice, shared by every session
+
+    Parameters
+    ----------
+    start : int
+        Start hour of the slice
+
+    Returns
+    -------
+    MatrixCache
+        Matrix store of the slice
+    """
+    if start not in slice_caches:
+        slice_caches[start] = MatrixCache(os.path.join(constants.MATRIX_STORE, f"slice_{start:02d}"))
+    return slice_caches[start]
+
 class LocationsMatrix:
     """
     Class to store distance/duration location matrices
@@ -27,48 +455,259 @@ class LocationsMatrix:
     ----------
     locations : List[str]
         List of locations
-    distances : List[List[float]]
-        Distance matrix in meters
-    durations : List[List[float]]
-        Duration matrix in seconds
+    coordinates : List[Tuple[float, float]]
+        (longitude, latitude) of each matrix row/column
+    distances : np.ndarray
+        float32 distance matrix in meters. Unroutable pairs are NaN
+    durations : np.ndarray
+        float32 duration matrix in seconds. Unroutable pairs are NaN
     lookup : Dict[str, int]
         Lookup dictionary for locations (address to index)
     use_cache : bool
-        Use cache to get geocode
+        Use cache to get geocode and travel times
+    cache : MatrixCache
+        Persistent matrix store used to only fetch missing pairs from OSRM. Defaults to the shared matrix_cache when use_cache is set
+    tile_size : int
+        Maximum number of sources and destinations per OSRM table request
+    max_workers : int
+        Maximum number of concurrent OSRM table requests
+    provider : str
+        'osrm' for road network matrices or 'haversine' for offline great-circle estimates. Set to 'haversine' when OSRM failed and the estimate was used instead
+    slices : Dict[int, np.ndarray]
+        Time-of-day duration matrices by slice start hour, computed on first use
+    addresses : helpers.AddressTable
+        Addresses resolved before building the matrix, None to geocode the locations
     """
-    def __init__(self, locations:List[str], use_case:bool=True) -> None:
+    def __init__(self, locations:List[str], use_case:bool=True, tile_size:int=constants.OSRM_TABLE_TILE_SIZE, max_workers:int=constants.OSRM_MAX_WORKERS, cache:Optional[MatrixCache]=None, provider:str=constants.MATRIX_PROVIDER, addresses:Optional[helpers.AddressTable]=None) -> None:
+        assert provider in ('osrm', 'haversine'), f"Invalid provider {provider}. Valid providers are 'osrm' and 'haversine'"
         self.locations = locations
+        self.coordinates = None
         self.distances = None
         self.durations = None
         self.lookup = None
         self.use_cache = use_case
+        self.cache = cache if cache is not None else (matrix_cache if use_case else None)
+        self.tile_size = tile_size
+        self.max_workers = max_workers
+        self.provider = provider
+        self.slices = {}
+        self.addresses = addresses
         self.compute_matrices()
 
-    def compute_matrices(self)->np.ndarray:
+    def geocode_locations(self)->Tuple[List[Tuple[float, float]], Dict[str, int]]:
         """
-        Compute and set duration and distance matrices for locations
+        Geocode locations, dropping the ones that fail.
+        Matrix rows are unique coordinates (rounded to constants.COORDINATE_PRECISION): addresses geocoding to the same point share a row
+
+        Returns
+        -------
+        Tuple[List[Tuple[float, float]], Dict[str, int]]
+            Coordinates of the matrix rows and lookup dictionary (address to index)
         """
         coords = []
+        rows = {}
         lookup = {}
+        if self.addresses is None:
+            self.addresses = helpers.AddressTable(self.locations, self.use_cache)
+        geocodes = self.addresses.resolve(self.locations)
+        for location in dict.fromkeys(self.locations):
+            geocode = geocodes[location]
+            if geocode is None:
+                continue
+            key = helpers.round_coordinate(geocode)
+            if key not in rows:
+                rows[key] = len(coords)
+                coords.append(list(key))
+            lookup[location] = rows[key]
+        if len(lookup) > len(coords):
+            logger.info(f"{len(lookup)} addresses share {len(coords)} matrix locations")
+        return coords, lookup
+
+    def compute_matrices(self)->None:
+        """
+        Compute and set duration and distance matrices for locations
+        """
+        coords, lookup = self.geocode_locations()
         locations = set(self.locations)
-        i = 0
-        for location in locations:
-            lookup[location] = i
-            geocode = helpers.get_geocode(location, self.use_cache)
-            if geocode is not None:
-                coords.append(geocode)
-                i += 1
-        
-        coords = ";".join([f"{coord[0]},{coord[1]}" for coord in coords])
-        url = f"{constants.OSRM_BASE_URL}/table/v1/driving/{coords}?annotations=distance,duration"
-        response = requests.get(url)
-
-        if response.status_code == 200:
-            self.durations = response.json()['durations']
-            self.distances= response.json()['distances']
-            self.lookup = lookup
+        if self.provider == 'haversine':
+            durations, distances = self.estimate(coords)
         else:
-            raise Exception(f"Failed to get duration matrix for {locations}:\n{response.text}")
+            try:
+                if self.cache is None:
+                    durations, distances = fetch_table(coords, tile_size=self.tile_size, max_workers=self.max_workers)
+                else:
+                    durations, distances = self.fetch_missing(coords)
+            except Exception as e:
+                if not constants.MATRIX_FALLBACK_TO_HAVERSINE:
+                    raise Exception(f"Failed to get duration matrix for {locations}:\n{e}")
+                logger.warning(f"Failed to get duration matrix from OSRM, falling back to great-circle estimates: {e}")
+                self.provider = 'haversine'
+                durations, distances = self.estimate(coords)
+        self.coordinates = coords
+        self.durations = durations.astype(np.float32)
+        self.distances = distances.astype(np.float32)
+        self.lookup = lookup
+
+    def estimate(self, coords:List[Tuple[float, float]])->Tuple[np.ndarray, np.ndarray]:
+        """
+        Estimate matrices from great-circle distances with the speed model fitted on cached OSRM results
+
+        Parameters
+        ----------
+        coords : List[Tuple[float, float]]
+            List of (longitude, latitude) coordinates
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Duration and distance matrices
+        """
+        model = (self.cache if self.cache is not None else matrix_cache).speed_model()
+        logger.info(f"Estimating matrix with detour factor {model['detour']:.2f} and speed {model['speed']:.1f} m/s (fitted on {model['pairs']} pairs)")
+        return estimate_matrices(coords, model)
+
+    def submatrices(self, selected:List[int])->Tuple[np.ndarray, np.ndarray]:
+        """
+        Get dense duration and distance matrices between selected locations
+
+        Parameters
+        ----------
+        selected : List[int]
+            Matrix indices of the locations
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Duration and distance matrices of shape (len(selected), len(selected)). Unroutable pairs are NaN
+        """
+        return self.durations[np.ix_(selected, selected)], self.distances[np.ix_(selected, selected)]
+
+    def save(self, directory:str)->None:
+        """
+        Save matrices to directory so they can be memory-mapped with LocationsMatrix.load
+
+        Parameters
+        ----------
+        directory : str
+            Directory to save the matrices in
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "durations.npy"), self.durations)
+        np.save(os.path.join(directory, "distances.npy"), self.distances)
+        with open(os.path.join(directory, "locations.json"), "w") as f:
+            json.dump({"locations": self.locations, "coordinates": self.coordinates, "lookup": self.lookup, "provider": self.provider}, f)
+
+    @classmethod
+    def load(cls, directory:str, mmap_mode:Optional[str]='r')->'LocationsMatrix':
+        """
+        Load matrices saved with LocationsMatrix.save (or SparseLocationsMatrix.save) without querying OSRM
+
+        Parameters
+        ----------
+        directory : str
+            Directory the matrices were saved in
+        mmap_mode : str, optional
+            Memory-map mode passed to np.load, by default 'r' (read-only, shared between processes). None to load in memory
+
+        Returns
+        -------
+        LocationsMatrix
+            Locations matrix
+        """
+        meta = json.load(open(os.path.join(directory, "locations.json"), "r"))
+        if meta.get('sparse', False):
+            return SparseLocationsMatrix.load(directory, mmap_mode)
+        matrix = cls.__new__(cls)
+        matrix.locations = meta['locations']
+        matrix.coordinates = meta['coordinates']
+        matrix.lookup = meta['lookup']
+        matrix.durations = np.load(os.path.join(directory, "durations.npy"), mmap_mode=mmap_mode)
+        matrix.distances = np.load(os.path.join(directory, "distances.npy"), mmap_mode=mmap_mode)
+        matrix.use_cache = True
+        matrix.cache = None
+        matrix.tile_size = constants.OSRM_TABLE_TILE_SIZE
+        matrix.max_workers = constants.OSRM_MAX_WORKERS
+        matrix.provider = meta.get('provider', 'osrm')
+        matrix.slices = {}
+        matrix.addresses = None
+        return matrix
+
+    def fetch_missing(self, coords:List[Tuple[float, float]], cache:Optional[MatrixCache]=None, base_url:str=constants.OSRM_BASE_URL)->Tuple[np.ndarray, np.ndarray]:
+        """
+        Get matrices from the cache and only fetch the rows and columns of missing pairs from OSRM
+
+        Parameters
+        ----------
+        coords : List[Tuple[float, float]]
+            List of (longitude, latitude) coordinates
+        cache : MatrixCache, optional
+            Matrix store to use, by default self.cache
+        base_url : str, optional
+            OSRM server URL, by default constants.OSRM_BASE_URL
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Duration and distance matrices. Unroutable pairs are NaN
+        """
+        cache = self.cache if cache is None else cache
+        durations, distances = cache.lookup(coords)
+        missing = np.isnan(durations)
+        if missing.any():
+            # locations not cached at all are fetched as full rows and columns,
+            # then pairs still missing between cached locations (stored by different runs) are fetched as one block
+            new = np.where(np.isnan(np.diag(durations)))[0]
+            known = np.where(~np.isnan(np.diag(durations)))[0]
+            blocks = [(new, np.arange(len(coords))), (known, new)]
+            remaining = missing.copy()
+            remaining[new, :] = False
+            remaining[:, new] = False
+            blocks.append((np.where(remaining.any(axis=1))[0], np.where(remaining.any(axis=0))[0]))
+            for sources, destinations in blocks:
+                if len(sources) == 0 or len(destinations) == 0:
+                    continue
+                fetched = fetch_table(coords, sources.tolist(), destinations.tolist(), tile_size=self.tile_size, max_workers=self.max_workers, base_url=base_url)
+                durations[np.ix_(sources, destinations)] = np.where(np.isnan(fetched[0]), np.inf, fetched[0])
+                distances[np.ix_(sources, destinations)] = np.where(np.isnan(fetched[1]), np.inf, fetched[1])
+            cache.update(coords, durations, distances)
+            cache.save()
+        stats = cache.stats()
+        logger.info(f"Matrix cache {cache.directory}: {stats['hits']} hits, {stats['misses']} misses ({stats['locations']} locations stored)")
+        durations[np.isinf(durations)] = np.nan
+        distances[np.isinf(distances)] = np.nan
+        return durations, distances
+
+    def slice_durations(self, start:int)->np.ndarray:
+        """
+        Get the duration matrix of a time-of-day slice, computing it on first use.
+        Slices with an OSRM server in constants.OSRM_SLICE_URLS are fetched incrementally through their own persistent store,
+        other slices scale the base durations by constants.TRAFFIC_PROFILE without querying OSRM
+
+        Parameters
+        ----------
+        start : int
+            Start hour of the slice, see time_slices
+
+        Returns
+        -------
+        np.ndarray
+            Duration matrix in seconds
+        """
+        if start in self.slices:
+            return self.slices[start]
+        durations = None
+        url = constants.OSRM_SLICE_URLS.get(start)
+        if url is not None and self.provider == 'osrm':
+            try:
+                durations, _ = self.fetch_missing(self.coordinates, slice_cache(start), url)
+            except Exception as e:
+                logger.warning(f"Failed to get duration matrix for slice {start}h from {url}, using traffic profile: {e}")
+        if durations is None:
+            hours = range(start, start + constants.MATRIX_TIME_SLICE_HOURS)
+            factor = np.mean([constants.TRAFFIC_PROFILE.get(hour % 24, 1.0) for hour in hours])
+            durations = self.durations*np.float32(factor)
+        self.slices[start] = np.asarray(durations, dtype=np.float32)
+        return self.slices[start]
 
     def get_duration(self, source:str, destination:str)->Union[float, None]:
         """
@@ -87,7 +726,8 @@ class LocationsMatrix:
             Duration between source and destination
         """
         try:
-            return self.durations[self.lookup[source]][self.lookup[destination]]
+            duration = self.durations[self.lookup[source], self.lookup[destination]]
+            return None if np.isnan(duration) else float(duration)
         except KeyError:
             logger.error(f"Failed to get duration for {source} and {destination}")
             logger.error(traceback.format_exc())
@@ -110,12 +750,469 @@ class LocationsMatrix:
             Distance between source and destination
         """
         try:
-            return self.distances[self.lookup[source]][self.lookup[destination]]
+            distance = self.distances[self.lookup[source], self.lookup[destination]]
+            return None if np.isnan(distance) else float(distance)
         except KeyError:
             logger.error(f"Failed to get distance for {source} and {destination}")
             logger.error(traceback.format_exc())
             return None
 
+    def indices(self, locations:Union[List[str], np.ndarray, pd.Series])->np.ndarray:
+        """
+        Get matrix indices (interned IDs) of locations
+
+        Parameters
+        ----------
+        locations : Union[List[str], np.ndarray, pd.Series]
+            Locations (addresses)
+
+        Returns
+        -------
+        np.ndarray
+            Index of each location, -1 for locations not in the matrix
+        """
+        return pd.Series(np.asarray(locations, dtype=object)).map(self.lookup).fillna(-1).to_numpy(dtype=np.int64)
+
+    def bulk_lookup(self, matrix:np.ndarray, sources:Union[List[str], List[int], np.ndarray, pd.Series], destinations:Union[List[str], List[int], np.ndarray, pd.Series])->Tuple[np.ndarray, np.ndarray]:
+        """
+        Look up many source/destination pairs in matrix at once
+
+        Parameters
+        ----------
+        matrix : np.ndarray
+            Duration or distance matrix
+        sources : Union[List[str], List[int], np.ndarray, pd.Series]
+            Source locations, either addresses or indices from LocationsMatrix.indices
+        destinations : Union[List[str], List[int], np.ndarray, pd.Series]
+            Destination locations, either addresses or indices from LocationsMatrix.indices
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Values (NaN where missing) and mask of missing pairs (unknown location or unroutable pair)
+        """
+        sources = np.asarray(sources)
+        destinations = np.asarray(destinations)
+        if not np.issubdtype(sources.dtype, np.integer):
+            sources = self.indices(sources)
+        if not np.issubdtype(destinations.dtype, np.integer):
+            destinations = self.indices(destinations)
+        known = (sources >= 0) & (destinations >= 0)
+        values = np.full(sources.shape, np.nan, dtype=np.float32)
+        values[known] = matrix[sources[known], destinations[known]]
+        return values, np.isnan(values)
+
+    def get_durations(self, sources:Union[List[str], List[int], np.ndarray, pd.Series], destinations:Union[List[str], List[int], np.ndarray, pd.Series], at:Union[List[datetime], np.ndarray, pd.Series, None]=None)->Tuple[np.ndarray, np.ndarray]:
+        """
+        Get durations between many sources and destinations (pairwise) at once
+
+        Parameters
+        ----------
+        sources : Union[List[str], List[int], np.ndarray, pd.Series]
+            Source locations, either addresses or indices from LocationsMatrix.indices
+        destinations : Union[List[str], List[int], np.ndarray, pd.Series]
+            Destination locations, either addresses or indices from LocationsMatrix.indices
+        at : Union[List[datetime], np.ndarray, pd.Series], optional
+            Time of each trip to use the matching time-of-day slice, by default None (static durations)
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Durations in seconds (NaN where missing) and mask of missing pairs
+        """
+        if at is None:
+            return self.bulk_lookup(self.durations, sources, destinations)
+        sources = np.asarray(sources)
+        destinations = np.asarray(destinations)
+        if not np.issubdtype(sources.dtype, np.integer):
+            sources = self.indices(sources)
+        if not np.issubdtype(destinations.dtype, np.integer):
+            destinations = self.indices(destinations)
+        starts = slice_of(at)
+        values = np.full(sources.shape, np.nan, dtype=np.float32)
+        for start in np.unique(starts):
+            selected = starts == start
+            values[selected], _ = self.bulk_lookup(self.slice_durations(int(start)), sources[selected], destinations[selected])
+        return values, np.isnan(values)
+
+    def get_distances(self, sources:Union[List[str], List[int], np.ndarray, pd.Series], destinations:Union[List[str], List[int], np.ndarray, pd.Series])->Tuple[np.ndarray, np.ndarray]:
+        """
+        Get distances between many sources and destinations (pairwise) at once
+
+        Parameters
+        ----------
+        sources : Union[List[str], List[int], np.ndarray, pd.Series]
+            Source locations, either addresses or indices from LocationsMatrix.indices
+        destinations : Union[List[str], List[int], np.ndarray, pd.Series]
+            Destination locations, either addresses or indices from LocationsMatrix.indices
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Distances in meters (NaN where missing) and mask of missing pairs
+        """
+        return self.bulk_lookup(self.distances, sources, destinations)
+
+class CSRMatrix:
+    """
+    Square sparse matrix in compressed sparse row format. Pairs not stored read as NaN
+
+    Attributes
+    ----------
+    size : int
+        Number of rows/columns
+    indptr : np.ndarray
+        Row pointers: values of row i are data[indptr[i]:indptr[i+1]]
+    indices : np.ndarray
+        Column of each stored value, sorted within rows
+    data : np.ndarray
+        float32 stored values
+    """
+    def __init__(self, size:int, rows:np.ndarray, columns:np.ndarray, values:np.ndarray) -> None:
+        keys = np.asarray(rows, dtype=np.int64)*size + np.asarray(columns, dtype=np.int64)
+        keys, first = np.unique(keys, return_index=True)
+        self.size = size
+        self.keys = keys
+        self.indptr = np.searchsorted(keys, np.arange(size + 1, dtype=np.int64)*size)
+        self.indices = keys % size
+        self.data = np.asarray(values, dtype=np.float32)[first]
+
+    @classmethod
+    def from_keys(cls, size:int, keys:np.ndarray, data:np.ndarray)->'CSRMatrix':
+        """
+        Build a matrix from sorted keys (row*size + column) and their values, e.g. memory-mapped arrays saved by SparseLocationsMatrix.save
+
+        Parameters
+        ----------
+        size : int
+            Number of rows/columns
+        keys : np.ndarray
+            Sorted int64 keys of the stored values
+        data : np.ndarray
+            float32 stored values
+
+        Returns
+        -------
+        CSRMatrix
+            Sparse matrix sharing keys and data
+        """
+        matrix = cls.__new__(cls)
+        matrix.size = size
+        matrix.keys = keys
+        matrix.indptr = np.searchsorted(keys, np.arange(size + 1, dtype=np.int64)*size)
+        matrix.indices = keys % max(size, 1)
+        matrix.data = data
+        return matrix
+
+    @property
+    def nnz(self)->int:
+        return len(self.data)
+
+    def __getitem__(self, pairs:Tuple[Union[int, np.ndarray], Union[int, np.ndarray]])->Union[np.float32, np.ndarray]:
+        rows, columns = pairs
+        keys = np.asarray(rows, dtype=np.int64)*self.size + np.asarray(columns, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.keys, keys), max(self.nnz - 1, 0))
+        if self.nnz == 0:
+            return np.full(keys.shape, np.nan, dtype=np.float32)[()]
+        return np.where(self.keys[positions] == keys, self.data[positions], np.float32(np.nan))[()]
+
+    def __mul__(self, factor:float)->'CSRMatrix':
+        scaled = CSRMatrix.__new__(CSRMatrix)
+        scaled.size, scaled.keys, scaled.indptr, scaled.indices = self.size, self.keys, self.indptr, self.indices
+        scaled.data = self.data*np.float32(factor)
+        return scaled
+
+    def to_dense(self, selected:Optional[List[int]]=None)->np.ndarray:
+        """
+        Get a dense matrix between selected indices, NaN where no value is stored
+
+        Parameters
+        ----------
+        selected : List[int], optional
+            Indices to keep, by default all
+
+        Returns
+        -------
+        np.ndarray
+            float32 matrix of shape (len(selected), len(selected))
+        """
+        selected = np.arange(self.size) if selected is None else np.asarray(selected, dtype=np.int64)
+        return self[selected[:, None], selected[None, :]].astype(np.float32)
+
+def compatible_pairs(coords:List[Tuple[float, float]], windows:np.ndarray, k:int=constants.SPARSE_K_NEAREST, max_gap:int=constants.SPARSE_MAX_GAP, block_size:int=1024)->Tuple[np.ndarray, np.ndarray]:
+    """
+    Find location pairs that can be consecutive stops: j is one of the k nearest locations of i (great-circle)
+    among the ones whose time window doesn't end before i's starts nor starts more than max_gap after i's ends
+
+    Parameters
+    ----------
+    coords : List[Tuple[float, float]]
+        List of (longitude, latitude) coordinates
+    windows : np.ndarray
+        (start, end) timestamps of the stops at each location, shape (len(coords), 2)
+    k : int, optional
+        Number of nearest compatible locations kept per location, by default constants.SPARSE_K_NEAREST
+    max_gap : int, optional
+        Maximum idle time between windows in seconds, by default constants.SPARSE_MAX_GAP
+    block_size : int, optional
+        Number of rows processed at once to bound memory, by default 1024
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Rows and columns of the compatible pairs
+    """
+    coords = np.asarray(coords, dtype=np.float32).reshape(-1, 2)
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 2)
+    k = min(k, len(coords))
+    rows, columns = [], []
+    for start in range(0, len(coords), block_size):
+        block = np.arange(start, min(start + block_size, len(coords)))
+        distances = helpers.haversine_matrix(coords[block], coords)
+        compatible = (windows[block, 0, None] <= windows[None, :, 1]) & (windows[None, :, 0] - windows[block, 1, None] <= max_gap)
+        distances[~compatible] = np.inf
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k] if k < len(coords) else np.broadcast_to(np.arange(len(coords)), (len(block), len(coords)))
+        keep = np.isfinite(np.take_along_axis(distances, nearest, axis=1))
+        rows.append(np.broadcast_to(block[:, None], nearest.shape)[keep])
+        columns.append(nearest[keep])
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(rows), np.concatenate(columns)
+
+class SparseLocationsMatrix(LocationsMatrix):
+    """
+    Locations matrix only computed for pairs that can be consecutive stops, stored as CSRMatrix.
+    Pairs are the k nearest time-window compatible locations of each location (see compatible_pairs),
+    the required pairs (e.g. pickup to delivery) and every pair involving a hub (e.g. vehicle depot).
+    Pairs not computed read as missing in lookups and as unroutable when sent to vroom
+
+    Attributes
+    ----------
+    windows : Dict[str, Tuple[int, int]]
+        (start, end) timestamps of the stops at each location. Locations without window are compatible with every other
+    required : List[Tuple[str, str]]
+        (source, destination) pairs always computed
+    hubs : List[str]
+        Locations computed against every other location
+    k : int
+        Number of nearest compatible locations computed per location
+    max_gap : int
+        Maximum idle time between windows in seconds
+    """
+    def __init__(self, locations:List[str], windows:Dict[str, Tuple[int, int]], required:List[Tuple[str, str]]=[], hubs:List[str]=[], k:int=constants.SPARSE_K_NEAREST, max_gap:int=constants.SPARSE_MAX_GAP, use_case:bool=True, tile_size:int=constants.OSRM_TABLE_TILE_SIZE, max_workers:int=constants.OSRM_MAX_WORKERS, provider:str=constants.MATRIX_PROVIDER, addresses:Optional[helpers.AddressTable]=None) -> None:
+        self.windows = windows
+        self.required = required
+        self.hubs = hubs
+        self.k = k
+        self.max_gap = max_gap
+        super().__init__(locations, use_case, tile_size, max_workers, provider=provider, addresses=addresses)
+
+    def candidate_pairs(self, coords:List[Tuple[float, float]], lookup:Dict[str, int])->Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the pairs to compute
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Rows and columns of the pairs
+        """
+        # addresses sharing a location merge their windows, locations without window are unbounded
+        unbounded = (np.iinfo(np.int64).min//4, np.iinfo(np.int64).max//4)
+        windows = np.array([[unbounded[1], unbounded[0]]]*len(coords), dtype=np.int64).reshape(-1, 2)
+        for location, window in self.windows.items():
+            if location in lookup:
+                windows[lookup[location], 0] = min(windows[lookup[location], 0], window[0])
+                windows[lookup[location], 1] = max(windows[lookup[location], 1], window[1])
+        empty = windows[:, 0] > windows[:, 1]
+        windows[empty] = unbounded
+        rows, columns = compatible_pairs(coords, windows, self.k, self.max_gap)
+        required = np.array([(lookup[s], lookup[d]) for s, d in self.required if s in lookup and d in lookup], dtype=np.int64).reshape(-1, 2)
+        hubs = np.array(sorted(set(lookup[hub] for hub in self.hubs if hub in lookup)), dtype=np.int64)
+        everything = np.arange(len(coords), dtype=np.int64)
+        rows = np.concatenate([rows, required[:, 0], np.repeat(hubs, len(coords)), np.tile(everything, len(hubs))])
+        columns = np.concatenate([columns, required[:, 1], np.tile(everything, len(hubs)), np.repeat(hubs, len(coords))])
+        keys = np.unique(rows*len(coords) + columns)
+        return keys//max(len(coords), 1), keys % max(len(coords), 1)
+
+    def fetch_pairs(self, coords:List[Tuple[float, float]], rows:np.ndarray, columns:np.ndarray)->Tuple[np.ndarray, np.ndarray]:
+        """
+        Fetch durations and distances of pairs from OSRM. Sources are grouped spatially in tiles
+        and each tile is fetched against the union of its sources' destinations
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Duration and distance of each pair
+        """
+        points = np.asarray(coords, dtype=float).reshape(-1, 2)
+        sources = np.unique(rows)
+        # nearby sources share most of their destinations
+        sources = sources[np.lexsort((points[sources, 1], np.round(points[sources, 0], 1)))]
+        groups = [sources[i:i+self.tile_size] for i in range(0, len(sources), self.tile_size)]
+        order = np.argsort(rows, kind='stable')
+        starts = np.searchsorted(rows[order], np.arange(len(coords) + 1))
+        durations = np.full(len(rows), np.nan, dtype=np.float32)
+        distances = np.full(len(rows), np.nan, dtype=np.float32)
+
+        def fetch(group:np.ndarray)->Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            pairs = np.concatenate([order[starts[source]:starts[source+1]] for source in group])
+            destinations = np.unique(columns[pairs])
+            fetched = fetch_table(coords, group.tolist(), destinations.tolist(), tile_size=self.tile_size, max_workers=1)
+            source_position = {source: i for i, source in enumerate(group)}
+            i = np.array([source_position[source] for source in rows[pairs]], dtype=np.int64)
+            j = np.searchsorted(destinations, columns[pairs])
+            return pairs, fetched[0][i, j], fetched[1][i, j]
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(groups)))) as executor:
+            for pairs, duration, distance in executor.map(fetch, groups):
+                durations[pairs] = duration
+                distances[pairs] = distance
+        return durations, distances
+
+    def compute_matrices(self)->None:
+        """
+        Compute and set sparse duration and distance matrices for locations
+        """
+        coords, lookup = self.geocode_locations()
+        rows, columns = self.candidate_pairs(coords, lookup)
+        logger.info(f"Sparse matrix: computing {len(rows)} of {len(coords)**2} pairs")
+        if self.provider == 'haversine':
+            durations, distances = self.estimate_pairs(coords, rows, columns)
+        else:
+            try:
+                durations, distances = self.fetch_pairs(coords, rows, columns)
+            except Exception as e:
+                if not constants.MATRIX_FALLBACK_TO_HAVERSINE:
+                    raise Exception(f"Failed to get sparse duration matrix for {len(coords)} locations:\n{e}")
+                logger.warning(f"Failed to get sparse duration matrix from OSRM, falling back to great-circle estimates: {e}")
+                self.provider = 'haversine'
+                durations, distances = self.estimate_pairs(coords, rows, columns)
+        self.coordinates = coords
+        self.durations = CSRMatrix(len(coords), rows, columns, durations)
+        self.distances = CSRMatrix(len(coords), rows, columns, distances)
+        self.lookup = lookup
+
+    def estimate_pairs(self, coords:List[Tuple[float, float]], rows:np.ndarray, columns:np.ndarray)->Tuple[np.ndarray, np.ndarray]:
+        """
+        Estimate durations and distances of pairs from great-circle distances, see LocationsMatrix.estimate
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Duration and distance of each pair
+        """
+        model = matrix_cache.speed_model()
+        points = np.asarray(coords, dtype=np.float32).reshape(-1, 2)
+        distances = helpers.haversine(points[rows], points[columns])*np.float32(model['detour'])
+        return distances/np.float32(model['speed']), distances
+
+    def slice_durations(self, start:int)->CSRMatrix:
+        """
+        Get the duration matrix of a time-of-day slice. Sparse slices only use constants.TRAFFIC_PROFILE
+
+        Parameters
+        ----------
+        start : int
+            Start hour of the slice, see time_slices
+
+        Returns
+        -------
+        CSRMatrix
+            Duration matrix in seconds
+        """
+        if start not in self.slices:
+            hours = range(start, start + constants.MATRIX_TIME_SLICE_HOURS)
+            self.slices[start] = self.durations*np.mean([constants.TRAFFIC_PROFILE.get(hour % 24, 1.0) for hour in hours])
+        return self.slices[start]
+
+    def submatrices(self, selected:List[int])->Tuple[np.ndarray, np.ndarray]:
+        return self.durations.to_dense(selected), self.distances.to_dense(selected)
+
+    def save(self, directory:str)->None:
+        """
+        Save the stored pairs to directory so they can be memory-mapped with LocationsMatrix.load.
+        Durations and distances are computed for the same pairs so their keys are saved once
+
+        Parameters
+        ----------
+        directory : str
+            Directory to save the matrices in
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "keys.npy"), self.durations.keys)
+        np.save(os.path.join(directory, "durations.npy"), self.durations.data)
+        np.save(os.path.join(directory, "distances.npy"), self.distances.data)
+        with open(os.path.join(directory, "locations.json"), "w") as f:
+            json.dump({"locations": self.locations, "coordinates": self.coordinates, "lookup": self.lookup, "provider": self.provider, "sparse": True,
+                       "windows": self.windows, "required": self.required, "hubs": self.hubs, "k": self.k, "max_gap": self.max_gap}, f)
+
+    @classmethod
+    def load(cls, directory:str, mmap_mode:Optional[str]='r')->'SparseLocationsMatrix':
+        """
+        Load matrices saved with SparseLocationsMatrix.save without querying OSRM
+
+        Parameters
+        ----------
+        directory : str
+            Directory the matrices were saved in
+        mmap_mode : str, optional
+            Memory-map mode passed to np.load, by default 'r' (read-only, shared between processes). None to load in memory
+
+        Returns
+        -------
+        SparseLocationsMatrix
+            Sparse locations matrix
+        """
+        matrix = cls.__new__(cls)
+        meta = json.load(open(os.path.join(directory, "locations.json"), "r"))
+        keys = np.load(os.path.join(directory, "keys.npy"), mmap_mode=mmap_mode)
+        matrix.locations = meta['locations']
+        matrix.coordinates = meta['coordinates']
+        matrix.lookup = meta['lookup']
+        matrix.durations = CSRMatrix.from_keys(len(matrix.coordinates), keys, np.load(os.path.join(directory, "durations.npy"), mmap_mode=mmap_mode))
+        matrix.distances = CSRMatrix.from_keys(len(matrix.coordinates), keys, np.load(os.path.join(directory, "distances.npy"), mmap_mode=mmap_mode))
+        matrix.use_cache = True
+        matrix.cache = None
+        matrix.tile_size = constants.OSRM_TABLE_TILE_SIZE
+        matrix.max_workers = constants.OSRM_MAX_WORKERS
+        matrix.provider = meta.get('provider', 'osrm')
+        matrix.slices = {}
+        matrix.addresses = None
+        matrix.windows = {location: tuple(window) for location, window in meta['windows'].items()}
+        matrix.required = [tuple(pair) for pair in meta['required']]
+        matrix.hubs = meta['hubs']
+        matrix.k = meta['k']
+        matrix.max_gap = meta['max_gap']
+        return matrix
+
+def location_windows(tasks:pd.DataFrame)->Dict[str, Tuple[int, int]]:
+    """
+    Get the envelope (earliest start, latest end) of the pickup and delivery time windows at each address
+
+    Parameters
+    ----------
+    tasks : pd.DataFrame
+        Shipment dataframe
+
+    Returns
+    -------
+    Dict[str, Tuple[int, int]]
+        (start, end) timestamps by address
+    """
+    earliest_pickup = pd.to_datetime(tasks['earliest_pickup'], errors='coerce')
+    latest_delivery = pd.to_datetime(tasks['latest_delivery'], errors='coerce')
+    wait = pd.Timedelta(seconds=constants.MAX_WAIT_TIME)
+    windows = pd.concat([
+        pd.DataFrame({"address": tasks['pickup_address'].to_numpy(), "start": earliest_pickup - wait, "end": latest_delivery}),
+        pd.DataFrame({"address": tasks['delivery_address'].to_numpy(), "start": latest_delivery - wait, "end": latest_delivery}),
+    ]).dropna(subset=['start', 'end'])
+    windows['start'] = windows['start'].astype('int64')//10**9
+    windows['end'] = windows['end'].astype('int64')//10**9
+    windows = windows.groupby('address').agg(start=('start', 'min'), end=('end', 'max'))
+    return {address: (int(row.start), int(row.end)) for address, row in windows.iterrows()}
+
+matrix_cache = MatrixCache()
+
 def preprocess_jobs(jdf:pd.DataFrame, use_cache:bool=True)->Dict[str, Any]:
     """
     Preprocess jobs dataframe to vroom format
@@ -135,6 +1232,7 @@ def preprocess_jobs(jdf:pd.DataFrame, use_cache:bool=True)->Dict[str, Any]:
     errors = {}
     mapper = {}
     jobs = []
+    geocodes = helpers.get_geocodes(jdf['pickup_address'].tolist(), use_cache)
     for i, row in jdf.iterrows():
         if 'service_time' not in row:
             row['service_time'] = constants.DEFAULT_SERVICE_TIME
@@ -146,7 +1244,7 @@ def preprocess_jobs(jdf:pd.DataFrame, use_cache:bool=True)->Dict[str, Any]:
             row['latest_delivery'] = pd.to_datetime(row['latest_delivery'])
         if 'nb_passengers' not in row:
             row['nb_passengers'] = 1
-        location = helpers.get_geocode(row.pickup_address, use_cache)
+        location = geocodes.get(row.pickup_address)
         if location is None:
             errors[row.job_id] = {
                 "vroom_id": i,
@@ -172,7 +1270,7 @@ def preprocess_jobs(jdf:pd.DataFrame, use_cache:bool=True)->Dict[str, Any]:
         "vroom_id_mapper": mapper
     }
 
-def preprocess_shipments(sdf:pd.DataFrame, use_cache:bool=True, matrix:List[List[float]]=None)->Dict[str, Any]:
+def preprocess_shipments(sdf:pd.DataFrame, use_cache:bool=True, matrix:Optional[LocationsMatrix]=None, addresses:Optional[helpers.AddressTable]=None)->Dict[str, Any]:
     """
     Preprocess shipments aka pickup-delivery dataframe to vroom format
     
@@ -182,8 +1280,10 @@ def preprocess_shipments(sdf:pd.DataFrame, use_cache:bool=True, matrix:List[List
         Job dataframe
     use_cache : bool, optional
         Use cache to get geocode, by default True
-    matrix : List[List[float]], optional
+    matrix : LocationsMatrix, optional
         Duration matrix between locations, by default None
+    addresses : helpers.AddressTable, optional
+        Addresses resolved beforehand, by default the matrix's
     
     Returns
     -------
@@ -194,47 +1294,68 @@ def preprocess_shipments(sdf:pd.DataFrame, use_cache:bool=True, matrix:List[List
     mapper = {}
     shipments = []
     if matrix is None:
-        addresses = list(set(sdf['pickup_address'].unique().tolist() + sdf['delivery_address'].unique().tolist()))
-        matrix = LocationsMatrix(addresses, use_cache)
-    for i, row in sdf.iterrows():
-        if 'service_time' not in row:
-            row['service_time'] = constants.DEFAULT_SERVICE_TIME
-        if 'skills' not in row:
-            row['skills'] = ",".join([str(i) for i in range(1, 5)])
-        if 'earliest_pickup' in row:
-            row['earliest_pickup'] = pd.to_datetime(row['earliest_pickup'])
-        if 'latest_delivery' in row:
-            row['latest_delivery'] = pd.to_datetime(row['latest_delivery'])
-        if 'nb_passengers' not in row:
-            row['nb_passengers'] = 1
-        pickup_location = helpers.get_geocode(row.pickup_address, use_cache)
-        delivery_location = helpers.get_geocode(row.delivery_address, use_cache)
-        duration = matrix.get_duration(row.pickup_address, row.delivery_address)
-        estimated_pickup_time = row.latest_delivery - timedelta(seconds=int(duration))
+        matrix = LocationsMatrix(list(dict.fromkeys(sdf['pickup_address'].tolist() + sdf['delivery_address'].tolist())), use_cache, addresses=addresses)
+    if addresses is None:
+        addresses = matrix.addresses if matrix.addresses is not None else helpers.AddressTable([], use_cache)
+    # travel time estimated with the traffic of the delivery time slice
+    geocodes = addresses.resolve(sdf['pickup_address'].tolist() + sdf['delivery_address'].tolist())
+    durations, missing = matrix.get_durations(sdf['pickup_address'], sdf['delivery_address'], at=pd.to_datetime(sdf['latest_delivery'], errors='coerce'))
+    n = len(sdf)
+    service_times = sdf['service_time'].tolist() if 'service_time' in sdf else [constants.DEFAULT_SERVICE_TIME]*n
+    skills = sdf['skills'].tolist() if 'skills' in sdf else [",".join([str(i) for i in range(1, 5)])]*n
+    nb_passengers = sdf['nb_passengers'].tolist() if 'nb_passengers' in sdf else [1]*n
+    parsed_skills = {value: helpers.parse_skills(value) for value in dict.fromkeys(skills)}
+    # time windows as whole columns, converted to timestamps once per distinct datetime
+    # unparseable or missing times are NaT and reported as errors of their rows
+    earliest_pickup = pd.to_datetime(sdf['earliest_pickup'], errors='coerce')
+    latest_delivery = pd.to_datetime(sdf['latest_delivery'], errors='coerce')
+    estimated_pickup = latest_delivery - pd.to_timedelta(np.where(missing, 0, durations).astype(np.int64), unit='s')
+    max_wait = timedelta(seconds=constants.MAX_WAIT_TIME)
+    pickup_starts = helpers.datetimes_to_timestamps(earliest_pickup - max_wait)
+    pickup_ends = helpers.datetimes_to_timestamps(earliest_pickup.where(earliest_pickup >= estimated_pickup, estimated_pickup))
+    delivery_starts = helpers.datetimes_to_timestamps(latest_delivery - max_wait)
+    delivery_ends = helpers.datetimes_to_timestamps(latest_delivery)
+    rows = zip(sdf.index, sdf['job_id'].tolist(), sdf['pickup_address'].tolist(), sdf['delivery_address'].tolist(), service_times, skills, nb_passengers, missing,
+               pickup_starts, pickup_ends, delivery_starts, delivery_ends)
+    for i, job_id, pickup_address, delivery_address, service_time, skill, passengers, no_duration, pickup_start, pickup_end, delivery_start, delivery_end in rows:
+        pickup_location = geocodes.get(pickup_address)
+        delivery_location = geocodes.get(delivery_address)
         if pickup_location is None or delivery_location is None:
-            errors[row.job_id] = {
+            errors[job_id] = {
                 "vroom_id": i,
                 "error": "Failed to convert pickup or delivery address to geocode"
             }
             continue
-        mapper[i] = row.job_id            
+        if no_duration:
+            errors[job_id] = {
+                "vroom_id": i,
+                "error": "Failed to get travel duration between pickup and delivery addresses"
+            }
+            continue
+        if pickup_start is None or delivery_end is None:
+            errors[job_id] = {
+                "vroom_id": i,
+                "error": "Failed to parse earliest pickup or latest delivery time"
+            }
+            continue
+        mapper[i] = job_id
         job = {
-            "amount": [row.nb_passengers],
-            "skills": helpers.parse_skills(row.skills),
+            "amount": [passengers],
+            "skills": list(parsed_skills[skill]),
             "pickup": {
                 "id": i,
-                "service": row.service_time,
+                "service": service_time,
                 "location": pickup_location,
                 "time_windows": [
-                    [helpers.str_to_timestamp(str(row.earliest_pickup-timedelta(seconds=constants.MAX_WAIT_TIME))), helpers.str_to_timestamp(str(max(row.earliest_pickup, estimated_pickup_time)))]
+                    [pickup_start, pickup_end]
                 ]
             },
             "delivery": {
                 "id": i,
-                "service": row.service_time,
+                "service": service_time,
                 "location": delivery_location,
                 "time_windows": [
-                    [helpers.str_to_timestamp(str(row.latest_delivery-timedelta(seconds=constants.MAX_WAIT_TIME))), helpers.str_to_timestamp(str(row.latest_delivery))]
+                    [delivery_start, delivery_end]
                 ]
             }
         }
@@ -246,9 +1367,10 @@ def preprocess_shipments(sdf:pd.DataFrame, use_cache:bool=True, matrix:List[List
         "vroom_id_mapper": mapper
     }
 
-def preprocess_vehicles(vdf:pd.DataFrame, use_cache:bool=True, date:datetime.date=datetime.today().date())->Dict[str, Any]:
+def preprocess_vehicles(vdf:pd.DataFrame, use_cache:bool=True, date:datetime.date=datetime.today().date(), addresses:Optional[helpers.AddressTable]=None)->Dict[str, Any]:
     """
-    Preprocess vehicles dataframe to vroom format
+    Preprocess vehicles dataframe to vroom format. Working hours and breaks ("HH:MM-HH:MM", comma separated for several breaks)
+    are parsed once per distinct value, and each depot address is geocoded once
 
     Parameters
     ----------
@@ -258,6 +1380,8 @@ def preprocess_vehicles(vdf:pd.DataFrame, use_cache:bool=True, date:datetime.dat
         Use cache to get geocode, by default True
     date : datetime.date, optional
         Date to use for start and end time, by default datetime.today().date
+    addresses : helpers.AddressTable, optional
+        Addresses resolved beforehand, by default None (depots are geocoded)
     
     Returns
     -------
@@ -267,26 +1391,39 @@ def preprocess_vehicles(vdf:pd.DataFrame, use_cache:bool=True, date:datetime.dat
     errors = {}
     mapper = {}
     vehicles = []
-    for i, row in vdf.iterrows():
-        time_window = helpers.get_timestamp_interval(date, row.working_hours)
-        start_location = helpers.get_geocode(row.address, use_cache)
-        end_location = helpers.get_geocode(row.address, use_cache)
-        if start_location is None or end_location is None:
-            errors[row.vehicle_id] = {
+    geocodes = addresses.resolve(vdf['address'].tolist()) if addresses is not None else helpers.get_geocodes(vdf['address'].tolist(), use_cache)
+    time_windows = helpers.parse_intervals(vdf['working_hours'], date)
+    breaks = helpers.parse_intervals(vdf['breaks'], date) if 'breaks' in vdf else [[]]*len(vdf)
+    skills = vdf['skills'].tolist()
+    parsed_skills = {value: helpers.parse_skills(value) for value in dict.fromkeys(skills)}
+    rows = zip(vdf.index, vdf['vehicle_id'].tolist(), vdf['address'].tolist(), vdf['capacity'].astype(int).tolist(), skills, time_windows, breaks)
+    for i, vehicle_id, address, capacity, skill, time_window, vehicle_breaks in rows:
+        location = geocodes.get(address)
+        if location is None:
+            errors[vehicle_id] = {
                 "vroom_id": i,
                 "error": "Failed to convert start/end address to geocode"
             }
             continue
-        mapper[i] = row.vehicle_id
+        if len(time_window) == 0:
+            errors[vehicle_id] = {
+                "vroom_id": i,
+                "error": "Failed to parse working hours"
+            }
+            continue
+        mapper[i] = vehicle_id
         vehicle = {
             "id": i,
-            "name": row.vehicle_id,
-            "start": start_location,
-            "end": end_location,
-            "capacity": [int(row.capacity)],
-            "skills": helpers.parse_skills(row.skills),
-            "time_window": time_window
+            "name": vehicle_id,
+            "start": location,
+            "end": location,
+            "capacity": [capacity],
+            "skills": list(parsed_skills[skill]),
+            "time_window": list(time_window[0])
         }
+        if len(vehicle_breaks) > 0:
+            # breaks start exactly at their scheduled time and last until its end
+            vehicle["breaks"] = [{"id": k, "time_windows": [[start, start]], "service": end - start} for k, (start, end) in enumerate(vehicle_breaks, 1)]
         vehicles.append(vehicle)
     return {
         "vehicles": vehicles,
@@ -294,7 +1431,98 @@ def preprocess_vehicles(vdf:pd.DataFrame, use_cache:bool=True, date:datetime.dat
         "vroom_id_mapper": mapper
     }
 
-def preprocess(vdf:pd.DataFrame, tasks:pd.DataFrame=None, task_type:str='shipment', use_cache:bool=True, save:bool=False, session_id:Union[str, None]=None)->List[List[dict]]:
+class PreprocessCache:
+    """
+    Output of the previous preprocess runs, so that preprocessing again after editing a few rows only processes the added and edited rows.
+    Rows are fingerprinted by their index (vroom id) and values
+
+    Attributes
+    ----------
+    rows : Dict[str, Dict[str, Dict[str, Any]]]
+        VROOM item, error and vroom id mapping of each row by kind ('vehicle' or 'shipment') and row fingerprint
+    addresses : helpers.AddressTable
+        Addresses resolved so far
+    matrix : LocationsMatrix
+        Locations matrix of the previous run
+    fingerprints : Dict[str, set]
+        Row fingerprints of the previous run by kind
+    """
+    def __init__(self)->None:
+        self.rows = {'vehicle': {}, 'shipment': {}}
+        self.addresses = None
+        self.matrix = None
+        self.fingerprints = {'vehicle': set(), 'shipment': set()}
+
+    @staticmethod
+    def fingerprint(df:pd.DataFrame, salt:str="")->List[str]:
+        return [f"{h:016x}{salt}" for h in pd.util.hash_pandas_object(df, index=True).tolist()]
+
+    def reusable_matrix(self, locations:List[str], tasks:pd.DataFrame, mode:str, provider:str, addresses:helpers.AddressTable)->Optional[LocationsMatrix]:
+        """
+        Matrix of the previous run if it covers the locations, including the ones that failed to geocode then and resolve now.
+        A sparse matrix also depends on the time windows, so it is only reused for unchanged tasks
+        """
+        if self.matrix is None or getattr(self.matrix, 'provider', None) != provider or (mode == 'sparse') != isinstance(self.matrix, SparseLocationsMatrix):
+            return None
+        if mode == 'sparse' and set(self.fingerprint(tasks)) != self.fingerprints['shipment']:
+            return None
+        if not set(locations) <= set(self.matrix.locations):
+            return None
+        if self.matrix.lookup is not None and any(location not in self.matrix.lookup and addresses.get(location) is not None for location in locations):
+            return None
+        return self.matrix
+
+    def process(self, kind:str, df:pd.DataFrame, process:Callable[[pd.DataFrame], Dict[str, Any]], salt:str="")->Dict[str, Any]:
+        """
+        Process the rows that were not processed before or that had an error with process and reuse the output of the others
+
+        Parameters
+        ----------
+        kind : str
+            'vehicle' or 'shipment'
+        df : pd.DataFrame
+            Vehicles or shipments
+        process : Callable[[pd.DataFrame], Dict[str, Any]]
+            preprocess_vehicles or preprocess_shipments applied to a subset of df
+        salt : str, optional
+            Other inputs the output depends on, by default ""
+
+        Returns
+        -------
+        Dict[str, Any]
+            Output of process over all of df, in row order
+        """
+        items = 'vehicles' if kind == 'vehicle' else 'shipments'
+        fingerprints = self.fingerprint(df, salt)
+        previous = self.rows[kind]
+        changed = [k for k, fingerprint in enumerate(fingerprints) if fingerprint not in previous or 'error' in previous[fingerprint]]
+        if len(changed) > 0:
+            subset = df.iloc[changed]
+            processed = process(subset)
+            fresh = {i: {} for i in subset.index}
+            for item in processed[items]:
+                fresh[item['id'] if kind == 'vehicle' else item['pickup']['id']]['item'] = item
+            for name, error in processed['errors'].items():
+                fresh[error['vroom_id']]['error'] = (name, error)
+            for i, name in processed['vroom_id_mapper'].items():
+                fresh[i]['name'] = name
+            previous = dict(previous, **{fingerprints[k]: fresh[i] for k, i in zip(changed, subset.index)})
+        logger.info(f"Preprocessed {len(changed)} of {len(df)} {kind} rows, reused {len(df) - len(changed)}")
+        output = {items: [], "errors": {}, "vroom_id_mapper": {}}
+        for i, fingerprint in zip(df.index, fingerprints):
+            row = previous[fingerprint]
+            if 'item' in row:
+                output[items].append(row['item'])
+            if 'error' in row:
+                output['errors'][row['error'][0]] = row['error'][1]
+            if 'name' in row:
+                output['vroom_id_mapper'][i] = row['name']
+        # rows removed since the previous run are dropped
+        self.rows[kind] = {fingerprint: previous[fingerprint] for fingerprint in fingerprints}
+        self.fingerprints[kind] = set(fingerprints)
+        return output
+
+def preprocess(vdf:pd.DataFrame, tasks:pd.DataFrame=None, task_type:str='shipment', use_cache:bool=True, save:bool=False, session_id:Union[str, None]=None, matrix_provider:str=constants.MATRIX_PROVIDER, matrix_mode:str=constants.MATRIX_MODE, cache:Optional[PreprocessCache]=None)->Tuple[List[dict], List[dict], List[dict], Dict[str, Any], Dict[str, Any], LocationsMatrix]:
     """
     Optimize route using vroom
 
@@ -306,23 +1534,57 @@ def preprocess(vdf:pd.DataFrame, tasks:pd.DataFrame=None, task_type:str='shipmen
         Job/Shipment dataframe
     task_type : str, optional
         Type of task, by default 'shipment'. Can be either 'job' or 'shipment'
+    matrix_provider : str, optional
+        'osrm' or 'haversine' (offline estimate), by default constants.MATRIX_PROVIDER
+    matrix_mode : str, optional
+        'dense' (all pairs) or 'sparse' (k-nearest, time-window compatible pairs only), by default constants.MATRIX_MODE
+    cache : PreprocessCache, optional
+        Output of the previous runs, to only process added and edited rows. Ignored when use_cache is False. By default None
     
     Returns
     -------
-    dict
-        Optimized route
+    Tuple[List[dict], List[dict], List[dict], Dict[str, Any], Dict[str, Any], LocationsMatrix]
+        Vehicles, jobs, shipments, errors, vroom id mapper and the locations matrix covering vehicles and tasks
     """
     assert task_type in ('job', 'shipment'), "task_type must be either 'job' or 'shipment'"
+    assert matrix_mode in ('dense', 'sparse'), "matrix_mode must be either 'dense' or 'sparse'"
     if task_type == 'job':
         raise NotImplementedError("Job optimization is not implemented yet. Only pickup-delivery (aka shipment) optimization is supported")
     else:
         print("-- Processing shipments --")
         job_processed = {"jobs": [], "errors": {}, "vroom_id_mapper": {}}
-        shi_processed = preprocess_shipments(tasks, use_cache)
-        date = pd.to_datetime(tasks['earliest_pickup']).min().date()
+        # every address is resolved once here and the table is handed to the matrix, shipments, vehicles and map rendering
+        cache = cache if use_cache else None
+        locations = list(dict.fromkeys(vdf['address'].tolist() + tasks['pickup_address'].tolist() + tasks['delivery_address'].tolist()))
+        start = time.perf_counter()
+        if cache is not None and cache.addresses is not None:
+            addresses = cache.addresses
+            addresses.resolve(locations)
+        else:
+            addresses = helpers.AddressTable(locations, use_cache)
+        logger.info(f"Resolved {len(locations)} unique addresses in {time.perf_counter() - start:.3f}s")
+        matrix = cache.reusable_matrix(locations, tasks, matrix_mode, matrix_provider, addresses) if cache is not None else None
+        # vehicle depots are part of the matrix so it can be sent to vroom as is
+        if matrix is None and matrix_mode == 'sparse':
+            required = list(zip(tasks['pickup_address'], tasks['delivery_address']))
+            matrix = SparseLocationsMatrix(locations, location_windows(tasks), required=required, hubs=vdf['address'].unique().tolist(), use_case=use_cache, provider=matrix_provider, addresses=addresses)
+        elif matrix is None:
+            matrix = LocationsMatrix(locations, use_cache, provider=matrix_provider, addresses=addresses)
+        if cache is not None:
+            # shipments depend on pickup to delivery durations, which only change with the matrix provider (e.g. OSRM failed and was estimated)
+            if cache.matrix is None or cache.matrix.provider != matrix.provider:
+                cache.rows['shipment'] = {}
+            shi_processed = cache.process('shipment', tasks, lambda sdf: preprocess_shipments(sdf, use_cache, matrix, addresses))
+            cache.addresses, cache.matrix = addresses, matrix
+        else:
+            shi_processed = preprocess_shipments(tasks, use_cache, matrix, addresses)
+        date = pd.to_datetime(tasks['earliest_pickup'], errors='coerce').min().date()
     
     print("-- Processing vehicles --")
-    veh_processed = preprocess_vehicles(vdf, use_cache, date)
+    if cache is not None:
+        veh_processed = cache.process('vehicle', vdf, lambda vdf: preprocess_vehicles(vdf, use_cache, date, addresses), salt=str(date))
+    else:
+        veh_processed = preprocess_vehicles(vdf, use_cache, date, addresses)
 
     errors = {
         'vehicle': veh_processed['errors'],
@@ -337,14 +1599,100 @@ def preprocess(vdf:pd.DataFrame, tasks:pd.DataFrame=None, task_type:str='shipmen
     if save:
         if session_id is None:
             session_id = str(int(datetime.timestamp(datetime.now())))
-        json.dump(veh_processed['vehicles'], open(os.path.join(constants.PREPROCESSED_STORE, f"{session_id}_vehicles.json"), "w"), indent=4)
-        json.dump(job_processed['jobs'], open(os.path.join(constants.PREPROCESSED_STORE, f"{session_id}_jobs.json"), "w"), indent=4)
-        json.dump(shi_processed['shipments'], open(os.path.join(constants.PREPROCESSED_STORE, f"{session_id}_shipments.json"), "w"), indent=4)
-        json.dump(errors, open(os.path.join(constants.PREPROCESSED_STORE, f"{session_id}_errors.json"), "w"), indent=4)
+        if constants.ARTIFACT_FORMAT == 'parquet':
+            helpers.write_artifact(vdf, "input_vehicles", session_id, date, constants.PREPROCESSED_STORE)
+            helpers.write_artifact(tasks, "input_jobs", session_id, date, constants.PREPROCESSED_STORE)
+            helpers.write_artifact(veh_processed['vehicles'], "vehicles", session_id, date, constants.PREPROCESSED_STORE)
+            helpers.write_artifact(job_processed['jobs'], "jobs", session_id, date, constants.PREPROCESSED_STORE)
+            helpers.write_artifact(shi_processed['shipments'], "shipments", session_id, date, constants.PREPROCESSED_STORE)
+            helpers.write_artifact([dict(error, entity=entity, name=name) for entity, items in errors.items() for name, error in items.items()], "errors", session_id, date, constants.PREPROCESSED_STORE)
+        else:
+            helpers.write_session({'vehicles': veh_processed['vehicles'], 'jobs': job_processed['jobs'], 'shipments': shi_processed['shipments'], 'errors': errors}, session_id, constants.PREPROCESSED_STORE, format=constants.ARTIFACT_FORMAT)
     
-    return veh_processed['vehicles'], job_processed['jobs'], shi_processed['shipments'], errors, mapper
+    return veh_processed['vehicles'], job_processed['jobs'], shi_processed['shipments'], errors, mapper, matrix
 
-def optimize(vehicles:List[dict], jobs:List[dict]=[], shipments:List[dict]=[], save:bool=False, session_id:Union[str, None]=None)->Union[dict, None]:
+def build_vroom_matrices(vehicles:List[dict], jobs:List[dict], shipments:List[dict], matrix:LocationsMatrix)->Union[Tuple[Dict[str, Any], List[dict], List[dict], List[dict]], None]:
+    """
+    Build vroom custom matrices from a locations matrix and reference them with location indices in vehicles, jobs and shipments
+
+    Parameters
+    ----------
+    vehicles : List[dict]
+        List of vehicles and their properties
+    jobs : List[dict]
+        List of jobs and their properties
+    shipments : List[dict]
+        List of shipments (pickup-delivery) and their properties
+    matrix : LocationsMatrix
+        Locations matrix covering every vehicle, job and shipment location
+
+    Returns
+    -------
+    Tuple[Dict[str, Any], List[dict], List[dict], List[dict]]
+        vroom matrices and copies of vehicles, jobs and shipments with location indices
+    NoneType
+        If some location is not in the matrix
+    """
+    rows = {helpers.round_coordinate(coord): i for i, coord in enumerate(matrix.coordinates)}
+    index = {}
+    def location_index(location:List[float])->int:
+        key = helpers.round_coordinate(location)
+        if key not in index:
+            index[key] = len(index)
+        return index[key]
+
+    vehicles = [dict(vehicle, start_index=location_index(vehicle['start']), end_index=location_index(vehicle['end'])) for vehicle in vehicles]
+    jobs = [dict(job, location_index=location_index(job['location'])) for job in jobs]
+    shipments = [
+        dict(
+            shipment,
+            pickup=dict(shipment['pickup'], location_index=location_index(shipment['pickup']['location'])),
+            delivery=dict(shipment['delivery'], location_index=location_index(shipment['delivery']['location']))
+        ) for shipment in shipments
+    ]
+    missing = [location for location in index if location not in rows]
+    if len(missing) > 0:
+        logger.warning(f"{len(missing)} locations are not in the matrix, letting vroom compute it")
+        return None
+
+    selected = [rows[location] for location in index]
+    matrices = {}
+    for name, values in zip(("durations", "distances"), matrix.submatrices(selected)):
+        values = np.asarray(values, dtype=float)
+        values = np.where(np.isnan(values), constants.VROOM_UNROUTABLE_COST, np.rint(values))
+        matrices[name] = values.astype(np.int64).tolist()
+    return {"car": matrices}, vehicles, jobs, shipments
+
+def save_solution(data:Dict[str, Any], solution:Dict[str, Any], session_id:str, store:str=constants.SOLUTION_STORE)->None:
+    """
+    Save a vroom problem and its solution as Parquet artifacts (see helpers.write_artifact): the problem's vehicles, jobs, shipments and matrix rows,
+    and the solution's summary, routes, flattened route steps (one row per step) and unassigned tasks
+
+    Parameters
+    ----------
+    data : Dict[str, Any]
+        vroom problem
+    solution : Dict[str, Any]
+        vroom solution
+    session_id : str
+        Session id
+    store : str, optional
+        Artifact store, by default constants.SOLUTION_STORE
+    """
+    starts = [vehicle['time_window'][0] for vehicle in data['vehicles'] if 'time_window' in vehicle]
+    date = (datetime.fromtimestamp(min(starts)) if len(starts) > 0 else datetime.now()).date()
+    helpers.write_artifact(data['vehicles'], "problem_vehicles", session_id, date, store)
+    helpers.write_artifact(data.get('jobs', []), "problem_jobs", session_id, date, store)
+    helpers.write_artifact(data.get('shipments', []), "problem_shipments", session_id, date, store)
+    if 'matrices' in data:
+        profile = data['matrices']['car']
+        helpers.write_artifact([{"index": i, "durations": durations, "distances": distances} for i, (durations, distances) in enumerate(zip(profile['durations'], profile['distances']))], "problem_matrices", session_id, date, store)
+    helpers.write_artifact([solution['summary']], "summary", session_id, date, store)
+    helpers.write_artifact([{key: value for key, value in route.items() if key != 'steps'} for route in solution['routes']], "routes", session_id, date, store)
+    helpers.write_artifact([dict(step, vehicle=route['vehicle'], step=k) for route in solution['routes'] for k, step in enumerate(route['steps'])], "steps", session_id, date, store)
+    helpers.write_artifact(solution['unassigned'], "unassigned", session_id, date, store)
+
+def optimize(vehicles:List[dict], jobs:List[dict]=[], shipments:List[dict]=[], save:bool=False, session_id:Union[str, None]=None, matrix:Optional[LocationsMatrix]=None)->Union[dict, None]:
     """
     Find the optimal route using vroom
 
@@ -356,6 +1704,8 @@ def optimize(vehicles:List[dict], jobs:List[dict]=[], shipments:List[dict]=[], s
         List of jobs and their properties
     shipments : List[dict]
         List of shipments (pickup-delivery) and their properties
+    matrix : LocationsMatrix, optional
+        Precomputed locations matrix sent as vroom custom matrices so vroom doesn't query OSRM for durations/distances, by default None
 
     Returns
     -------
@@ -365,32 +1715,173 @@ def optimize(vehicles:List[dict], jobs:List[dict]=[], shipments:List[dict]=[], s
         If optimization failed
     """
     
+    matrices = None
+    if matrix is not None:
+        custom = build_vroom_matrices(vehicles, jobs, shipments, matrix)
+        if custom is not None:
+            matrices, vehicles, jobs, shipments = custom
+
     data = {'vehicles': vehicles, 'options': {'g': True, 'geometry': True, 'format': 'json'}}
+    if matrices is not None:
+        data['matrices'] = matrices
     if len(jobs) > 0:
         data['jobs'] = jobs
     if len(shipments) > 0:
         data['shipments'] = shipments
 
-    response = requests.post(vroom_url, json=data)
+    # encoded once with orjson, the same bytes are saved with the session
+    payload = helpers.dump_json(data)
+    response = requests.post(vroom_url, data=payload, headers={'Content-Type': 'application/json'})
     if response.status_code == 200:
-        solution = response.json()
+        solution = orjson.loads(response.content)
         if save:
             if session_id is None:
                 session_id = str(int(datetime.timestamp(datetime.now())))
-            json.dump(solution, open(os.path.join(constants.SOLUTION_STORE, f"{session_id}_solution.json"), "w"), indent=4)
-            json.dump(data, open(os.path.join(constants.SOLUTION_STORE, f"{session_id}_data.json"), "w"), indent=4)
+            if constants.ARTIFACT_FORMAT == 'parquet':
+                save_solution(data, solution, session_id)
+            else:
+                helpers.write_session({'solution': solution, 'data': data}, session_id, constants.SOLUTION_STORE, encoded={'solution': response.content, 'data': payload}, format=constants.ARTIFACT_FORMAT)
         return solution
     else:
         logger.error(f"Error: {response.text}")
         return None
 
+def solve_date(vdf:pd.DataFrame, tasks:pd.DataFrame, task_type:str='shipment', use_cache:bool=True, save:bool=False, session_id:Union[str, None]=None, matrix_provider:str=constants.MATRIX_PROVIDER, matrix_mode:str=constants.MATRIX_MODE)->Dict[str, Any]:
+    """
+    Preprocess and solve the tasks of a single service date (a routing.batch worker)
+
+    Parameters
+    ----------
+    vdf : pd.DataFrame
+        Vehicles
+    tasks : pd.DataFrame
+        Tasks of the date
+    task_type : str, optional
+        'shipment' or 'job', by default 'shipment'
+    use_cache : bool, optional
+        Use the address and matrix caches, by default True
+    save : bool, optional
+        Save the preprocessed problem and the solution, by default False
+    session_id : str, optional
+        Session id, by default None
+    matrix_provider : str, optional
+        Matrix provider, by default constants.MATRIX_PROVIDER
+    matrix_mode : str, optional
+        Matrix mode, by default constants.MATRIX_MODE
+
+    Returns
+    -------
+    Dict[str, Any]
+        Preprocessed vehicles, jobs and shipments, preprocessing errors, vroom id mapper and solution (None if nothing could be solved or optimization failed)
+    """
+    vehicles, jobs, shipments, errors, mapper, matrix = preprocess(vdf, tasks=tasks, task_type=task_type, use_cache=use_cache, save=save, session_id=session_id, matrix_provider=matrix_provider, matrix_mode=matrix_mode)
+    solution = None
+    if len(vehicles) > 0 and len(jobs) + len(shipments) > 0:
+        solution = optimize(vehicles, jobs=jobs, shipments=shipments, save=save, session_id=session_id, matrix=matrix if constants.VROOM_USE_CUSTOM_MATRICES else None)
+    return {"vehicles": vehicles, "jobs": jobs, "shipments": shipments, "errors": errors, "mapper": mapper, "solution": solution}
+
+def combine_summaries(summaries:List[Dict[str, Any]])->Dict[str, Any]:
+    """
+    Combine vroom solution summaries: costs, counts and durations are added up, amounts element-wise and violations are concatenated
+
+    Parameters
+    ----------
+    summaries : List[Dict[str, Any]]
+        vroom solution summaries
+
+    Returns
+    -------
+    Dict[str, Any]
+        Combined summary
+    """
+    combined = {}
+    for summary in summaries:
+        for key, value in summary.items():
+            if isinstance(value, dict):
+                combined[key] = combine_summaries([combined.get(key, {}), value])
+            elif isinstance(value, list) and all(isinstance(item, (int, float)) for item in value):
+                previous = combined.get(key, [])
+                combined[key] = [a + b for a, b in itertools.zip_longest(previous, value, fillvalue=0)]
+            elif isinstance(value, list):
+                combined[key] = combined.get(key, []) + value
+            elif isinstance(value, (int, float)):
+                combined[key] = combined.get(key, 0) + value
+    return combined
+
+def batch(vdf:pd.DataFrame, tasks:pd.DataFrame, task_type:str='shipment', use_cache:bool=True, save:bool=False, session_id:Union[str, None]=None, max_workers:int=constants.BATCH_MAX_WORKERS, matrix_provider:str=constants.MATRIX_PROVIDER, matrix_mode:str=constants.MATRIX_MODE)->Tuple[Dict[str, Dict[str, Any]], Dict[str, Any]]:
+    """
+    Partition tasks by service date (latest_delivery) and preprocess and solve each date independently across a process pool.
+    Addresses are geocoded once beforehand so workers only read them from the shared address cache and the geocoder rate limit holds.
+    Workers are spawned and import the caller's main module, so scripts must call batch under if __name__ == "__main__".
+    Each date is saved under session_id_YYYY-MM-DD
+
+    Parameters
+    ----------
+    vdf : pd.DataFrame
+        Vehicles, available on every date
+    tasks : pd.DataFrame
+        Tasks of any number of dates
+    task_type : str, optional
+        'shipment' or 'job', by default 'shipment'
+    use_cache : bool, optional
+        Use the address and matrix caches. Without the address cache workers can't share geocodes, so dates are solved one at a time, by default True
+    save : bool, optional
+        Save the preprocessed problems and the solutions, by default False
+    session_id : str, optional
+        Session id, by default the current timestamp
+    max_workers : int, optional
+        Number of worker processes, by default constants.BATCH_MAX_WORKERS
+    matrix_provider : str, optional
+        Matrix provider, by default constants.MATRIX_PROVIDER
+    matrix_mode : str, optional
+        Matrix mode, by default constants.MATRIX_MODE
+
+    Returns
+    -------
+    Tuple[Dict[str, Dict[str, Any]], Dict[str, Any]]
+        Results of each date (see solve_date, None if it failed) and combined summary of the solved dates, with the number of dates, solved dates and failed dates
+    """
+    if session_id is None:
+        session_id = str(int(datetime.timestamp(datetime.now())))
+    dates = pd.to_datetime(tasks['latest_delivery']).dt.strftime('%Y-%m-%d')
+    if use_cache:
+        start = time.perf_counter()
+        addresses = list(dict.fromkeys(vdf['address'].tolist() + tasks['pickup_address'].tolist() + tasks['delivery_address'].tolist()))
+        helpers.AddressTable(addresses, use_cache)
+        logger.info(f"Resolved {len(addresses)} unique addresses for {dates.nunique()} dates in {time.perf_counter() - start:.3f}s")
+    else:
+        max_workers = 1
+
+    results = {}
+    # workers are spawned, not forked: the caller (e.g. the app) is multi-threaded and SQLite connections must not cross a fork
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {
+            date: executor.submit(solve_date, vdf, group, task_type, use_cache, save, f"{session_id}_{date}", matrix_provider, matrix_mode)
+            for date, group in tasks.groupby(dates, sort=True)
+        }
+        for date, future in futures.items():
+            try:
+                results[date] = future.result()
+            except Exception:
+                logger.error(f"Failed to preprocess and solve {date}")
+                logger.error(traceback.format_exc())
+                results[date] = None
+
+    solutions = [result['solution'] for result in results.values() if result is not None and result['solution'] is not None]
+    summary = combine_summaries([solution['summary'] for solution in solutions])
+    summary['dates'] = len(results)
+    summary['solved_dates'] = len(solutions)
+    summary['failed_dates'] = [date for date, result in results.items() if result is None or result['solution'] is None]
+    logger.info(f"Solved {len(solutions)} of {len(results)} dates")
+    return results, summary
+
 if __name__ == "__main__":
     from pprint import pprint
     helpers.initialize_directories()
     vdf = pd.read_csv("data/vehicles.csv").dropna(subset=['skills'])
     jdf = pd.read_csv("data/jobs.csv")
 
-    vehicles, jobs, shipments, errors, mapper = preprocess(vdf, sdf=jdf, use_cache=True, save=True)   
+    vehicles, jobs, shipments, errors, mapper, matrix = preprocess(vdf, tasks=jdf, use_cache=True, save=True)   
     # solution = optimize(vehicles, jobs=jobs, shipments=shipments, save=True)
 
     # addresses = list(json.load(open("data/addresses.json", "r")).keys())